@@ -0,0 +1,162 @@
+# Benchmark for fixcoveragefilepaths.py. Generates a mixed-case source tree
+# and synthetic Cobertura reports over it in a temporary directory, and times
+# the parse, resolve and write phases of modifyXML as well as the streaming
+# mode separately, recording the peak memory of each. Runs on any platform,
+# the report paths use \ separators like the ones of OpenCppCoverage.
+
+import xml.etree.ElementTree as xml
+from collections import OrderedDict
+import contextlib, io, json, os, platform, random, shutil, sys, tempfile, time, getopt, tracemalloc
+import fixcoveragefilepaths as fix
+
+#----------- Generate a source tree with mixed-case names -----------
+# Returns the paths of the files relative to root, with \ separators
+def makeSourceTree(root, files, width=6, depth=3, seed=0):
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    def name(length=8):
+        return "".join(rng.choice(letters) for _ in range(length)).title() + rng.choice("Ab_")
+    dirs = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [os.path.join(parent, name()) for parent in level for _ in range(width)]
+        dirs += level
+    paths = []
+    for i in range(files):
+        directory = rng.choice(dirs)
+        if not os.path.isdir(os.path.join(root, directory)):
+            os.makedirs(os.path.join(root, directory))
+        path = os.path.join(directory, name() + rng.choice([".cpp", ".h", ".HPP"]))
+        open(os.path.join(root, path), "w").close()
+        paths.append(path.replace(os.sep, "\\"))
+    return paths
+
+#----------- Write a synthetic Cobertura report -----------
+# Every class refers to one of the files, with randomly changed case, and
+# files are repeated across packages once there are more classes than files
+def writeReport(path, root, files, classes, lines=20, packages=10, seed=0):
+    rng = random.Random(seed)
+    def scramble(text):
+        return "".join(c.upper() if rng.random() < 0.5 else c.lower() for c in text)
+    with io.open(path, "w", encoding="utf-8") as out:
+        out.write(u'<?xml version="1.0" encoding="utf-8"?>\n'
+                  u'<coverage line-rate="0.5" branch-rate="0" version="1.9" timestamp="0">\n'
+                  u'  <sources>\n    <source>%s</source>\n  </sources>\n  <packages>\n' % root)
+        per_package = (classes + packages - 1) // packages
+        for package in range(packages):
+            out.write(u'    <package name="Module%d.dll" line-rate="0.5" branch-rate="0" complexity="0">\n'
+                      u'      <classes>\n' % package)
+            for index in range(package * per_package, min(classes, (package + 1) * per_package)):
+                filename = scramble(files[index % len(files)])
+                out.write(u'        <class name="%s" filename="%s" line-rate="0.5" branch-rate="0" complexity="0">\n'
+                          u'          <methods />\n          <lines>\n'
+                          % (os.path.basename(filename.replace("\\", "/")), filename))
+                for number in range(1, lines + 1):
+                    out.write(u'            <line number="%d" hits="%d" />\n' % (number, rng.randint(0, 2)))
+                out.write(u'          </lines>\n        </class>\n')
+            out.write(u'      </classes>\n    </package>\n')
+        out.write(u'  </packages>\n</coverage>\n')
+
+#----------- Time and trace the memory of a function -----------
+# Returns (seconds, peak bytes, result). The function runs twice, timed
+# without tracing and traced with tracemalloc.
+def measure(function):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        result = function()
+        seconds = time.time() - start
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak, result
+
+#----------- Benchmark all phases on one report -----------
+def runCase(workdir, root, files, classes, lines):
+    report = os.path.join(workdir, "coverage_%d.xml" % classes)
+    output = os.path.join(workdir, "coverage_%d_fixed.xml" % classes)
+    writeReport(report, root, files, classes, lines)
+    result = OrderedDict([("classes", classes), ("files", len(files)),
+                          ("report_bytes", os.path.getsize(report))])
+
+    seconds, peak, tree = measure(lambda: xml.ElementTree(file=report))
+    result["parse"] = OrderedDict([("seconds", seconds), ("peak_bytes", peak)])
+
+    source_dir = tree.getroot().find("sources/source").text
+    prefix = fix.sourcePrefix(source_dir, root)
+    def resolve():
+        resolver = fix.CasedPathResolver()
+        for class_elem in tree.getroot().iter("class"):
+            filename = class_elem.attrib["filename"]
+            fix.fixClassPath(class_elem, source_dir, prefix, resolver)
+            class_elem.attrib["filename"] = filename
+        return resolver
+    seconds, peak, resolver = measure(resolve)
+    result["resolve"] = OrderedDict([("seconds", seconds), ("peak_bytes", peak),
+                                     ("directories_scanned", resolver.scanned),
+                                     ("cache_hits", resolver.hits), ("cache_misses", resolver.misses)])
+
+    seconds, peak, _ = measure(lambda: tree.write(output, encoding="utf-8", xml_declaration=True))
+    result["write"] = OrderedDict([("seconds", seconds), ("peak_bytes", peak)])
+
+    seconds, peak, _ = measure(lambda: fix.modifyXMLStreaming(report, root, output))
+    result["stream"] = OrderedDict([("seconds", seconds), ("peak_bytes", peak)])
+    os.remove(report)
+    os.remove(output)
+    return result
+
+def main(argv):
+    resultsfile = "benchmarkfixcoveragefilepaths.json"
+    sizes = [1000, 10000, 100000]
+    files = 2000
+    lines = 20
+    usage = ('benchmarkfixcoveragefilepaths.py [-o <resultsfile>] [-n <classes>[,<classes>...]] '
+             '[-f <files>] [-l <lines>]')
+    try:
+        opts, args = getopt.getopt(argv,"ho:n:f:l:",["ofile=","classes=","files=","lines="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            print('  -o, --ofile    write the results as JSON to resultsfile')
+            print('  -n, --classes  comma separated numbers of classes of the generated reports')
+            print('  -f, --files    number of files of the generated source tree')
+            print('  -l, --lines    number of lines per class')
+            sys.exit()
+        elif opt in ("-o", "--ofile"):
+            resultsfile = arg
+        elif opt in ("-n", "--classes"):
+            sizes = [int(size) for size in arg.split(",")]
+        elif opt in ("-f", "--files"):
+            files = int(arg)
+        elif opt in ("-l", "--lines"):
+            lines = int(arg)
+
+    workdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(workdir, "Src")
+        paths = makeSourceTree(root, files)
+        cases = []
+        for classes in sizes:
+            case = runCase(workdir, root, paths, classes, lines)
+            cases.append(case)
+            print("%8d classes (%10d bytes): %s" % (classes, case["report_bytes"], "  ".join(
+                "%s %7.3fs %6.1fus/class %10dB" % (phase, case[phase]["seconds"],
+                                                   case[phase]["seconds"] * 1e6 / classes,
+                                                   case[phase]["peak_bytes"])
+                for phase in ("parse", "resolve", "write", "stream"))))
+    finally:
+        shutil.rmtree(workdir)
+    with open(resultsfile, "w") as f:
+        json.dump(OrderedDict([("python", platform.python_version()),
+                               ("platform", platform.platform()),
+                               ("files", files), ("lines", lines),
+                               ("cases", cases)]), f, indent=2)
+
+#----------------------------------------------------------------------
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -22,9 +22,126 @@
  =============================================================================*/
  """
 import json
+import re
 import types
 from collections import OrderedDict
 
+try:
+    import jsonschema
+except ImportError:
+    # Only needed to validate manifests
+    jsonschema = None
+
+# The C++ expressions opening and closing a json object, the C++ type of the
+# result and an empty object of that type, for every supported map type.
+# None generates plain std::map objects, the others generate
+# cppmicroservices::AnyMap objects of the given any_map::map_type, like the
+# ones the DS metadata parser works with.
+map_types = {
+    None: ('std::map<std::string, Any> ({\n', '})', 'std::map<std::string, Any>',
+           'std::map<std::string, Any>()'),
+    'ORDERED_MAP': ('AnyMap(any_map::ordered_any_map({\n', '}))', 'AnyMap',
+                    'AnyMap(any_map::ORDERED_MAP)'),
+    'UNORDERED_MAP': ('AnyMap(any_map::unordered_any_map({\n', '}))', 'AnyMap',
+                      'AnyMap(any_map::UNORDERED_MAP)'),
+    'UNORDERED_MAP_CASEINSENSITIVE_KEYS':
+        ('AnyMap(any_map::unordered_any_cimap({\n', '}))', 'AnyMap',
+         'AnyMap(any_map::UNORDERED_MAP_CASEINSENSITIVE_KEYS)'),
+}
+
+# The loader rebuilding AnyMap objects from the flat tables written by
+# write_flat_anymap_definition. Nodes are stored parent first, so walking
+# them backwards every node is complete before it is moved into its parent.
+flat_loader = r"""#ifndef ANYMAP_FLAT_LOADER
+#define ANYMAP_FLAT_LOADER
+
+#include <algorithm>
+#include <cstddef>
+#include <utility>
+
+enum AnyMapFlatKind : unsigned char
+{
+  ANYMAP_FLAT_MAP,
+  ANYMAP_FLAT_VECTOR,
+  ANYMAP_FLAT_STRING,
+  ANYMAP_FLAT_INT,
+  ANYMAP_FLAT_BOOL,
+  ANYMAP_FLAT_LONG_LONG
+};
+
+struct AnyMapFlatNode
+{
+  unsigned char kind;
+  int parent;
+  std::size_t key;
+  std::size_t key_size;
+  long long value;
+  std::size_t value_size;
+};
+
+template <typename Map>
+Map LoadAnyMapFlat(AnyMapFlatNode const* nodes,
+                   std::size_t count,
+                   char const* strings,
+                   Map const& empty)
+{
+  std::vector<Any> values(count);
+  for (std::size_t i = 0; i < count; ++i)
+  {
+    AnyMapFlatNode const& node = nodes[i];
+    switch (node.kind)
+    {
+      case ANYMAP_FLAT_MAP:
+        values[i] = empty;
+        break;
+      case ANYMAP_FLAT_VECTOR:
+        values[i] = std::vector<Any>();
+        break;
+      case ANYMAP_FLAT_STRING:
+        values[i] = std::string(strings + node.value, node.value_size);
+        break;
+      case ANYMAP_FLAT_INT:
+        values[i] = static_cast<int>(node.value);
+        break;
+      case ANYMAP_FLAT_BOOL:
+        values[i] = node.value != 0;
+        break;
+      case ANYMAP_FLAT_LONG_LONG:
+        values[i] = node.value;
+        break;
+    }
+  }
+  for (std::size_t i = count; i-- > 0;)
+  {
+    AnyMapFlatNode const& node = nodes[i];
+    if (node.kind == ANYMAP_FLAT_VECTOR)
+    {
+      // Elements were appended last to first
+      auto& elements = cppmicroservices::ref_any_cast<std::vector<Any>>(values[i]);
+      std::reverse(elements.begin(), elements.end());
+    }
+    if (node.parent < 0)
+    {
+      continue;
+    }
+    Any& parent = values[node.parent];
+    if (nodes[node.parent].kind == ANYMAP_FLAT_MAP)
+    {
+      cppmicroservices::ref_any_cast<Map>(parent)[std::string(strings + node.key, node.key_size)]
+        = std::move(values[i]);
+    }
+    else
+    {
+      cppmicroservices::ref_any_cast<std::vector<Any>>(parent).push_back(std::move(values[i]));
+    }
+  }
+  return std::move(cppmicroservices::ref_any_cast<Map>(values[0]));
+}
+
+#endif // ANYMAP_FLAT_LOADER
+
+"""
+
 def lookahead(iterable):
     """Pass through all values from the given iterable, augmented by the
     information if there are more values to come after the current one
@@ -37,21 +154,393 @@ def lookahead(iterable):
         last = val
     yield last, False
 
-def get_anymap_declaration(json_str, key=None, indent=0):
+def get_anymap_declaration(json_str, key=None, indent=0, map_type=None):
     """Given a json_str representing a json string, with optionally a name "key"
-    at the top level and indentation specified by "indent",
+    at the top level, indentation specified by "indent" and one of the
+    map_types to generate json objects as,
     Return a C++ AnyMap representation of the json in string format.
     """
-    return '\n'.join(generate_indent(get_json_string(json_str, key), indent))
+    return '\n'.join(generate_indent(get_json_string(json_str, key, map_type), indent))
+
+def write_anymap_declaration(out, json_str, key=None, indent=0, map_type=None):
+    """Given a json_str representing a json string, with optionally a name "key"
+    at the top level, indentation specified by "indent" and one of the
+    map_types to generate json objects as,
+    Write the C++ AnyMap representation of the json to the file-like object
+    "out" as it is generated. The output is identical to get_anymap_declaration
+    but the declaration is never held in memory as a whole.
+    """
+    write_indented(out, generate_anymap(get_json_node(json_str, key), 0,
+                                        map_type=map_type), indent)
+
+def write_indented(out, tokens, indent=0):
+    """Write the tokens generated by generate_anymap to the file-like object
+    "out", with every line indented by "indent" spaces.
+    """
+    pad = ' ' * indent
+    out.write(pad)
+    for token in tokens:
+        out.write(token.replace('\n', '\n' + pad))
+
+def write_preamble(out, map_type=None):
+    """Write the includes and using-declarations the generated AnyMap
+    definitions of the given map_type depend on to the file-like object "out".
+    """
+    out.write('#include <map>\n')
+    out.write('#include <string>\n')
+    out.write('#include <vector>\n')
+    out.write('#include "cppmicroservices/Any.h"\n')
+    if map_type:
+        out.write('#include "cppmicroservices/AnyMap.h"\n')
+    out.write('\n')
+    out.write('using cppmicroservices::Any;\n')
+    if map_type:
+        out.write('using cppmicroservices::AnyMap;\n')
+        out.write('using cppmicroservices::any_map;\n')
+    out.write('\n')
+
+def write_anymap_definition(out, name, json_str, key=None, indent=2, map_type=None):
+    """Write a C++ constant called "name" holding the AnyMap representation
+    of json_str to the file-like object "out", preceded by the json itself
+    in a comment.
+    """
+    out.write('/*\n')
+    out.write(json_str)
+    out.write('*/\n')
+    out.write('const ' + map_types[map_type][2] + ' ' + name + ' =\n')
+    write_anymap_declaration(out, json_str, key, indent, map_type)
+    out.write(';\n\n')
+
+def write_shared_anymap_definitions(out, jsondict, key=None, indent=2,
+                                    prefix='anymap_shared_', map_type=None):
+    """Given an OrderedDict jsondict with keys = names of C++ constants and
+    values = json strings, write the AnyMap definitions of all of them to the
+    file-like object "out" like write_anymap_definition does, except that
+    map, vector and string subtrees occurring more than once are written only
+    once, as "static const" objects named by "prefix" and a number, and are
+    referred to by name wherever they occur.
+    """
+    nodes = [get_json_node(json_str, key) for json_str in jsondict.itervalues()]
+    subtrees, shared = find_shared_subtrees(nodes, prefix)
+    for name, node in subtrees:
+        out.write('static const %s %s =\n' % (cpp_type(node, map_type), name))
+        write_indented(out, generate_anymap(node, 0, shared, map_type), indent)
+        out.write(';\n\n')
+    for (name, json_str), node in zip(jsondict.iteritems(), nodes):
+        out.write('/*\n')
+        out.write(json_str)
+        out.write('*/\n')
+        out.write('const ' + map_types[map_type][2] + ' ' + name + ' =\n')
+        if id(node) in shared:
+            out.write(' ' * indent + shared[id(node)])
+        else:
+            write_indented(out, generate_anymap(node, 0, shared, map_type), indent)
+        out.write(';\n\n')
+
+def cpp_type(node, map_type=None):
+    """Return the C++ type generate_anymap represents the json node with,
+    or None for nodes which are not worth sharing.
+    """
+    if type(node) == OrderedDict:
+        return map_types[map_type][2]
+    elif type(node) == types.ListType:
+        return 'std::vector<Any>'
+    elif type(node) == types.StringType or type(node) == types.UnicodeType:
+        return 'std::string'
+    return None
+
+def find_shared_subtrees(nodes, prefix):
+    """Given a list of parsed json nodes, find the map, vector and string
+    subtrees which would be generated more than once because they are
+    structurally identical. Subtrees nested in another shared subtree only
+    count once for that subtree.
+    Return a tuple of (subtrees, shared), where subtrees is a list of
+    (C++ name, node) tuples with one representative node per shared subtree,
+    nested subtrees before the ones containing them, and shared is a dict with
+    keys = id() of every occurrence of a shared subtree and values = its name.
+    """
+    numbers = {}        # id() of node -> number of its structure
+    structures = {}     # structure -> number
+    representatives = []
+    children = []
+    for root in nodes:
+        # Number the structures bottom up, children before their parents
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if type(node) == OrderedDict:
+                kids = node.values()
+            elif type(node) == types.ListType:
+                kids = node
+            else:
+                kids = []
+            if kids and not expanded:
+                stack.append((node, True))
+                stack.extend((kid, False) for kid in kids)
+                continue
+            if type(node) == OrderedDict:
+                structure = (OrderedDict, tuple((k, numbers[id(v)])
+                                                for k, v in node.iteritems()))
+            elif type(node) == types.ListType:
+                structure = (list, tuple(numbers[id(v)] for v in node))
+            else:
+                structure = (type(node), node)
+            number = structures.get(structure)
+            if number is None:
+                number = structures[structure] = len(representatives)
+                representatives.append(node)
+                children.append([numbers[id(kid)] for kid in kids])
+            numbers[id(node)] = number
+
+    # Count how often each structure is generated once every structure is
+    # generated only once.
+    uses = [0] * len(representatives)
+    for root in nodes:
+        uses[numbers[id(root)]] += 1
+    for kids in children:
+        for kid in kids:
+            uses[kid] += 1
+
+    names = {}
+    subtrees = []
+    for number, node in enumerate(representatives):
+        if uses[number] > 1 and cpp_type(node):
+            names[number] = prefix + str(len(subtrees))
+            subtrees.append((names[number], node))
+    shared = dict((node_id, names[number])
+                  for node_id, number in numbers.iteritems() if number in names)
+    return subtrees, shared
+
+def write_flat_anymap_definition(out, name, json_str, key=None, map_type=None):
+    """Write a C++ constant called "name" holding the AnyMap representation
+    of json_str to the file-like object "out", preceded by the json itself
+    in a comment, like write_anymap_definition does. Instead of a nested
+    initializer, the json is written as a constexpr table of nodes and a pool
+    of strings, which the flat_loader code (which has to be written to "out"
+    first) turns into the AnyMap at runtime.
+    Raise a ValueError naming the constant if the json is not an object or
+    holds an integer which does not fit in a long long.
+    """
+    node = get_json_node(json_str, key)
+    if type(node) != OrderedDict:
+        raise ValueError('%s: only json objects can be written as flat tables' % name)
+    try:
+        rows, pool = flatten_anymap(node)
+    except ValueError as e:
+        raise ValueError('%s: %s' % (name, e))
+    out.write('/*\n')
+    out.write(json_str)
+    out.write('*/\n')
+    out.write('static constexpr AnyMapFlatNode %s_nodes[] = {\n' % name)
+    for row in rows:
+        out.write('  { %d, %d, %d, %d, %d, %d },\n' % row)
+    out.write('};\n')
+    out.write('static constexpr char %s_strings[] =' % name)
+    if len(pool) > 65535:
+        # MSVC does not support longer string literals. Character literals
+        # keep bytes above 127 from being narrowed where char is signed.
+        out.write(' {\n')
+        for start in range(0, len(pool), 16):
+            out.write('  ' + ','.join("'%s'" % escape_char(c, "'")
+                                      for c in pool[start:start + 16]) + ',\n')
+        out.write('  0 };\n')
+    else:
+        out.write('\n')
+        for start in range(0, max(len(pool), 1), 64):
+            out.write('  "%s"\n' % ''.join(escape_char(c) for c in pool[start:start + 64]))
+        out.write('  ;\n')
+    out.write('const %s %s =\n' % (map_types[map_type][2], name))
+    out.write('  LoadAnyMapFlat(%s_nodes, %d, %s_strings, %s);\n\n'
+              % (name, len(rows), name, map_types[map_type][3]))
 
-def get_json_string(json_str, key=None):
+def escape_char(c, quote='"'):
+    """Return the character c of a UTF-8 encoded string as it is written
+    in a C++ string literal, or in a character literal if quote is "'".
+    """
+    if c in '\\?' or c == quote:
+        return '\\' + c
+    if ' ' <= c <= '~':
+        return c
+    return '\\%03o' % ord(c)
+
+def flatten_anymap(node):
+    """Given a parsed json node, Return a tuple of (rows, pool), where rows is
+    a list of (kind, parent index, key offset, key size, value, value size)
+    tuples describing every node of the json tree, parents before their
+    children, and pool is the UTF-8 encoded string all keys and string values
+    are stored in. The value of a string is its offset in the pool, the value
+    of an int or bool is the number itself. Integers which do not fit in an
+    int get their own kind and are loaded as long long; a ValueError is
+    raised for those not fitting either.
+    """
+    rows = []
+    offsets = {}
+    pool = []
+    pool_size = [0]
+    def intern(string):
+        if type(string) == types.UnicodeType:
+            string = string.encode('utf-8')
+        offset = offsets.get(string)
+        if offset is None:
+            offset = offsets[string] = pool_size[0]
+            pool.append(string)
+            pool_size[0] += len(string)
+        return offset, len(string)
+
+    stack = [(node, -1, None)]
+    while stack:
+        node, parent, key = stack.pop()
+        key_offset, key_size = intern(key) if key is not None else (0, 0)
+        index = len(rows)
+        if type(node) == OrderedDict:
+            rows.append((0, parent, key_offset, key_size, 0, 0))
+            stack.extend((val, index, k) for k, val in reversed(node.items()))
+        elif type(node) == types.ListType:
+            rows.append((1, parent, key_offset, key_size, 0, 0))
+            stack.extend((elem, index, None) for elem in reversed(node))
+        elif type(node) == types.StringType or type(node) == types.UnicodeType:
+            rows.append((2, parent, key_offset, key_size) + intern(node))
+        elif type(node) == types.BooleanType:
+            rows.append((4, parent, key_offset, key_size, int(node), 0))
+        elif type(node) == types.IntType or type(node) == types.LongType:
+            if not -2**63 < node < 2**63:
+                raise ValueError('integer %d does not fit in a long long' % node)
+            kind = 3 if -2**31 <= node < 2**31 else 5
+            rows.append((kind, parent, key_offset, key_size, node, 0))
+    return rows, ''.join(pool)
+
+def get_json_node(json_str, key=None):
     """Given a json_str representing a json string, with optionally a name "key"
-    at the top level, Return a C++ AnyMap representation of the json in string format.
+    at the top level, Return the parsed json node to generate the AnyMap from.
     """
     scrmap = json.loads(json_str, object_pairs_hook=OrderedDict)
     if key:
         scrmap = scrmap[key]
-    return ''.join(generate_anymap(scrmap, 0))
+    return scrmap
+
+def get_json_string(json_str, key=None, map_type=None):
+    """Given a json_str representing a json string, with optionally a name "key"
+    at the top level and one of the map_types to generate json objects as,
+    Return a C++ AnyMap representation of the json in string format.
+    """
+    return ''.join(generate_anymap(get_json_node(json_str, key), 0, map_type=map_type))
+
+def get_schema_validator(schema_path):
+    """Given the path of a json schema, such as schemas/manifest_schema.json,
+    Return a jsonschema validator for it. The schema is checked and compiled
+    once, so the validator should be reused for every json of a batch.
+    """
+    if jsonschema is None:
+        raise ImportError('validating manifests requires the jsonschema package')
+    with open(schema_path) as f:
+        schema = json.load(f)
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+    return validator_class(schema)
+
+def parse_errors(json_str):
+    """Return a list holding a tuple of (offset, message) for the error if
+    json_str is not valid json, or an empty list if it is.
+    """
+    try:
+        json.loads(json_str)
+    except ValueError as e:
+        # Python 2 only states the offset in the message
+        offset = getattr(e, 'pos', None)
+        if offset is None:
+            match = re.search(r'\(char (\d+)', str(e))
+            offset = int(match.group(1)) if match else 0
+        return [(offset, 'invalid json: %s' % e)]
+    return []
+
+def validate_json(validator, json_str):
+    """Given a validator as returned by get_schema_validator and a json_str
+    representing a json string, Return a list of tuples of (offset, message)
+    for every error, sorted by the offset in json_str of the offending value.
+    A json_str which is not valid json yields a single error.
+    """
+    errors = parse_errors(json_str)
+    if errors:
+        return errors
+    node = json.loads(json_str)
+    for error in validator.iter_errors(node):
+        path = list(error.absolute_path)
+        errors.append((get_json_offset(json_str, path), '%s: %s' % (
+            '/'.join(str(step) for step in path) or '<root>', error.message)))
+    return sorted(errors)
+
+def locate_errors(jsondict, locations, find_errors):
+    """Given an OrderedDict with keys = names and values = json strings, and
+    a dict "locations" with keys = the names and values = tuples of (source
+    path, offset of the json in the source, ...), call find_errors on every
+    json string, which returns a list of tuples of (offset, message). Return
+    a list of error messages of the form
+    "<source path>:<line>: <name>: <message>", in input order.
+    """
+    sources = {}
+    messages = []
+    for name, json_str in jsondict.iteritems():
+        errors = find_errors(json_str)
+        if not errors:
+            continue
+        path, start = locations[name][:2]
+        if path not in sources:
+            with open(path, 'rb') as f:
+                sources[path] = f.read()
+        first_line = sources[path].count('\n', 0, start) + 1
+        for offset, message in errors:
+            messages.append('%s:%d: %s: %s' % (
+                path, first_line + json_str.count('\n', 0, offset), name, message))
+    return messages
+
+def check_manifests(jsondict, locations):
+    """Like validate_manifests, but only report jsons which do not parse."""
+    return locate_errors(jsondict, locations, parse_errors)
+
+def validate_manifests(jsondict, schema_path, locations):
+    """Given an OrderedDict with keys = names and values = json strings, and
+    a dict "locations" as taken by locate_errors, validate every json against
+    the json schema at schema_path. Return a list of error messages of the
+    form "<source path>:<line>: <name>: <message>", in input order.
+    """
+    validator = get_schema_validator(schema_path)
+    return locate_errors(jsondict, locations,
+                         lambda json_str: validate_json(validator, json_str))
+
+def get_json_offset(json_str, path):
+    """Given a json_str representing a json string and a path of object keys
+    and array indices, Return the offset in json_str of the value at that
+    path, or of the deepest value on the path found.
+    """
+    decoder = json.JSONDecoder()
+    skip = lambda pos: json.decoder.WHITESPACE.match(json_str, pos).end()
+    offset = skip(0)
+    for step in path:
+        opening = json_str[offset:offset + 1]
+        if opening not in ('{', '['):
+            break
+        pos = skip(offset + 1)
+        index = 0
+        found = None
+        while json_str[pos:pos + 1] not in ('', '}', ']'):
+            if opening == '{':
+                name, pos = decoder.raw_decode(json_str, pos)
+                pos = skip(skip(pos) + 1)
+                if name == step:
+                    found = pos
+            elif index == step:
+                found = pos
+            if found is not None:
+                break
+            value, pos = decoder.raw_decode(json_str, pos)
+            pos = skip(pos)
+            if json_str[pos:pos + 1] == ',':
+                pos = skip(pos + 1)
+            index += 1
+        if found is None:
+            break
+        offset = found
+    return offset
 
 def generate_indent(json_str, num=0):
     """Given a json_str representing a json string, with optionally
@@ -60,43 +549,64 @@ def generate_indent(json_str, num=0):
     for line in json_str.split('\n'):
         yield ' '*num + line
 
-def generate_anymap(node, level):
+def generate_anymap(node, level, shared=None, map_type=None):
     """Given a json node object specified by node and the level of the json tree
     hierarchy, parse the json and generate the C++ AnyMap representation in string
-    format.
+    format. Json objects are generated as the C++ type map_types associates
+    with map_type.
+    Nested nodes whose id() is a key of the optional dict "shared" are
+    generated as the C++ name it maps them to.
+    The json tree is walked with an explicit stack instead of recursion, so every
+    token is yielded exactly once regardless of the nesting depth and deeply
+    nested trees do not hit the interpreter's recursion limit.
     """
-    if type(node) == OrderedDict:
-        yield 'std::map<std::string, Any> ({\n'
-        for dictitem, has_more in lookahead(node.iteritems()):
-            key, val = dictitem
-            yield '  ' * (level + 1)
-            yield '{{ "{0}", Any('.format(key)
-            for line in generate_anymap(val, level + 1):
-                yield line
-            if has_more:
-                yield ')},'
-            else:
-                yield ')}'
-            yield '\n'
-        yield '  ' * level
-        yield '})'
-    elif type(node) == types.ListType:
-        yield 'std::vector<Any> {\n'
-        for elem, has_more in lookahead(node):
-            yield '  ' * (level + 1)
-            for line in generate_anymap(elem, level + 1):
-                yield line
-            if has_more:
-                yield ','
-            yield '\n'
-        yield '  ' * level
-        yield '}'
-    elif type(node) == types.IntType:
-        yield str(node)
-    elif type(node) == types.BooleanType:
-        yield 'true' if node else 'false'
-    elif type(node) == types.StringType or type(node) == types.UnicodeType:
-        yield 'std::string("{0}")'.format(node)
+    # The stack holds either tokens (strings) still to be yielded or
+    # (node, level) tuples still to be expanded, in reverse output order.
+    map_open, map_close = map_types[map_type][:2]
+    stack = [(node, level)]
+    while stack:
+        item = stack.pop()
+        if type(item) != tuple:
+            yield item
+            continue
+        node, level = item
+        if type(node) == OrderedDict:
+            yield map_open
+            pending = []
+            for dictitem, has_more in lookahead(node.iteritems()):
+                key, val = dictitem
+                pending.append('  ' * (level + 1))
+                pending.append('{{ "{0}", Any('.format(key))
+                if shared and id(val) in shared:
+                    pending.append(shared[id(val)])
+                else:
+                    pending.append((val, level + 1))
+                pending.append(')},' if has_more else ')}')
+                pending.append('\n')
+            pending.append('  ' * level)
+            pending.append(map_close)
+            stack.extend(reversed(pending))
+        elif type(node) == types.ListType:
+            yield 'std::vector<Any> {\n'
+            pending = []
+            for elem, has_more in lookahead(node):
+                pending.append('  ' * (level + 1))
+                if shared and id(elem) in shared:
+                    pending.append(shared[id(elem)])
+                else:
+                    pending.append((elem, level + 1))
+                if has_more:
+                    pending.append(',')
+                pending.append('\n')
+            pending.append('  ' * level)
+            pending.append('}')
+            stack.extend(reversed(pending))
+        elif type(node) == types.IntType:
+            yield str(node)
+        elif type(node) == types.BooleanType:
+            yield 'true' if node else 'false'
+        elif type(node) == types.StringType or type(node) == types.UnicodeType:
+            yield 'std::string("{0}")'.format(node)
 
 if __name__ == "__main__":
     test_str = """
@@ -0,0 +1,222 @@
+"""
+/*=============================================================================
+
+ Library: CppMicroServices
+
+ Copyright (c) The CppMicroServices developers. See the COPYRIGHT
+ file at the top-level directory of this distribution and at
+ https://github.com/CppMicroServices/CppMicroServices/COPYRIGHT .
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ =============================================================================*/
+ """
+
+import gc
+import getopt
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import timeit
+from collections import OrderedDict
+from JsonToAnyMap import generate_anymap, generate_indent, get_json_node, \
+    write_anymap_declaration
+
+usage = ('JsonToAnyMapPerfTest.py [-o <results_json>] [-r <repeats>] '
+         '[-w <widths>] [-d <depths>] [-s <string_lengths>]')
+
+phases = ['parse', 'emit', 'indent', 'stream']
+
+def make_manifest(width, depth, string_length, seed=0):
+    """Return the json string of a synthetic SCR manifest with "width"
+    components, each with "width" interfaces and references and a properties
+    object nested "depth" levels deep holding "width" values per level. All
+    strings are "string_length" characters long. The same arguments always
+    produce the same manifest.
+    """
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    def string():
+        return ''.join(rng.choice(letters) for _ in range(string_length))
+
+    components = []
+    for _ in range(width):
+        properties = OrderedDict()
+        level = properties
+        for _ in range(depth):
+            for i in range(width):
+                level['value%d' % i] = [string(), i, i % 2 == 0][i % 3]
+            level['nested'] = OrderedDict()
+            level = level['nested']
+        components.append(OrderedDict([
+            ('implementation-class', string()),
+            ('activate', 'Activate'),
+            ('inject-references', True),
+            ('service', OrderedDict([
+                ('scope', 'singleton'),
+                ('interfaces', [string() for _ in range(width)])])),
+            ('references', [OrderedDict([
+                ('name', string()),
+                ('interface', string()),
+                ('policy', 'dynamic')]) for _ in range(width)]),
+            ('properties', properties)]))
+    return json.dumps(OrderedDict([('scr', OrderedDict([
+        ('version', 1), ('components', components)]))]), indent=2)
+
+class NullWriter(object):
+    """A file-like object discarding everything written to it."""
+    def write(self, data):
+        pass
+
+def make_phase(phase, json_str):
+    """Return a function running the given phase of the generator on json_str.
+    The inputs of the phase are computed up front, so only the phase itself
+    is measured.
+    """
+    if phase == 'parse':
+        return lambda: get_json_node(json_str, 'scr')
+    node = get_json_node(json_str, 'scr')
+    if phase == 'emit':
+        return lambda: ''.join(generate_anymap(node, 0))
+    if phase == 'indent':
+        anymap = ''.join(generate_anymap(node, 0))
+        return lambda: '\n'.join(generate_indent(anymap, 2))
+    return lambda: write_anymap_declaration(NullWriter(), json_str, 'scr', 2)
+
+def read_proc_status(field):
+    """Return the value of the given field of /proc/self/status in kB."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+def measure_peak_rss(phase, json_str):
+    """Return how many bytes the peak RSS grew above the current RSS while
+    running the phase. The peak is reset through /proc/self/clear_refs first.
+    Memory freed earlier in the process is reused without growing the RSS,
+    so this is only meaningful in a process doing nothing else, see
+    measure_phase_memory.
+    """
+    run = make_phase(phase, json_str)
+    gc.collect()
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = read_proc_status('VmRSS')
+    run()
+    return (read_proc_status('VmHWM') - before) * 1024
+
+def measure_phase_memory(phase, json_path):
+    """Return the peak RSS growth in bytes of running the phase on the json
+    file at json_path in a fresh interpreter, which runs this script with
+    the -p option.
+    """
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                      '-p', phase, json_path])
+    return int(output)
+
+def run_case(width, depth, string_length, repeats):
+    """Benchmark every phase on one synthetic manifest and Return a dict with
+    the manifest parameters, its size and the best time and peak memory of
+    each phase.
+    """
+    json_str = make_manifest(width, depth, string_length)
+    result = OrderedDict([('width', width), ('depth', depth),
+                          ('string_length', string_length),
+                          ('json_bytes', len(json_str))])
+    fd, json_path = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(json_str)
+        for phase in phases:
+            run = make_phase(phase, json_str)
+            seconds = min(timeit.repeat(run, number=1, repeat=repeats))
+            peak = measure_phase_memory(phase, json_path)
+            result[phase] = OrderedDict([('seconds', seconds), ('peak_bytes', peak)])
+    finally:
+        os.remove(json_path)
+    return result
+
+def parse_list(arg):
+    return [int(value) for value in arg.split(',')]
+
+if __name__ == "__main__":
+    # Invoke like so:
+    # python JsonToAnyMapPerfTest.py [-o <results_json>] [-r <repeats>]
+    #                                [-w <widths>] [-d <depths>] [-s <string_lengths>]
+    # Widths, depths and string lengths are comma separated lists; every
+    # combination of them is benchmarked. The parse, emit, indent and stream
+    # (write_anymap_declaration) phases are timed separately, taking the best
+    # of <repeats> runs. Peak memory is measured as the peak RSS growth
+    # reported by Linux while running the phase once in a fresh interpreter,
+    # so it has a granularity of pages and small manifests report little or
+    # nothing.
+    # With -p, which is only used internally, the phase is run once on the
+    # json file given as argument and the peak RSS growth is printed.
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:r:w:d:s:p:")
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit(2)
+    results_path = 'JsonToAnyMapPerfTest.json'
+    repeats = 5
+    widths = [10, 50]
+    depths = [1, 10, 100]
+    string_lengths = [16, 256]
+    measured_phase = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt == '-o':
+            results_path = arg
+        elif opt == '-r':
+            repeats = int(arg)
+        elif opt == '-w':
+            widths = parse_list(arg)
+        elif opt == '-d':
+            depths = parse_list(arg)
+        elif opt == '-s':
+            string_lengths = parse_list(arg)
+        elif opt == '-p':
+            if arg not in phases or len(args) != 1:
+                print(usage)
+                sys.exit(2)
+            measured_phase = arg
+
+    if measured_phase is not None:
+        with open(args[0]) as f:
+            print(measure_peak_rss(measured_phase, f.read()))
+        sys.exit()
+
+    cases = []
+    for width in widths:
+        for depth in depths:
+            for string_length in string_lengths:
+                case = run_case(width, depth, string_length, repeats)
+                cases.append(case)
+                print('width %4d depth %4d strings %4d (%9d bytes): %s' % (
+                    width, depth, string_length, case['json_bytes'],
+                    '  '.join('%s %8.4fs %10dB' % (phase, case[phase]['seconds'],
+                                                   case[phase]['peak_bytes'])
+                              for phase in phases)))
+    with open(results_path, 'w') as f:
+        json.dump(OrderedDict([
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('repeats', repeats),
+            ('memory', 'peak_rss'),
+            ('cases', cases)]), f, indent=2)
@@ -0,0 +1,220 @@
+"""
+/*=============================================================================
+
+ Library: CppMicroServices
+
+ Copyright (c) The CppMicroServices developers. See the COPYRIGHT
+ file at the top-level directory of this distribution and at
+ https://github.com/CppMicroServices/CppMicroServices/COPYRIGHT .
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ =============================================================================*/
+ """
+
+import getopt
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from JsonToAnyMap import flat_loader, map_types, validate_manifests, write_anymap_definition, \
+    write_flat_anymap_definition, write_preamble, write_shared_anymap_definitions
+
+usage = ('ManifestsToAnyMap.py [-j <jobs>] [-k <key>] [-i <index_hpp>] [-s | -f] [-m <map_type>] '
+         '[-v <schema_json>] <output_dir> <manifest_file_or_dir>...')
+
+def find_manifests(paths, filename='manifest.json'):
+    """Given a list of paths to manifest files or directories, Return an
+    OrderedDict with keys = C++ variable names unique across all manifests
+    and values = paths of the manifest files. Directories are searched
+    recursively for files called "filename".
+    """
+    manifests = OrderedDict()
+    for path in paths:
+        if os.path.isdir(path):
+            found = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                if filename in filenames:
+                    found.append(os.path.join(dirpath, filename))
+            root = path
+        else:
+            found = [path]
+            root = os.curdir
+        for manifest in found:
+            relpath = os.path.splitext(os.path.relpath(manifest, root))[0]
+            name = re.sub(r'\W', '_', relpath).lstrip('_')
+            if not name or name[0].isdigit():
+                # Not a valid C++ identifier, e.g. for 3rdparty/manifest.json
+                name = 'm_' + name
+            unique_name = name
+            count = 1
+            while unique_name in manifests:
+                count += 1
+                unique_name = '%s_%d' % (name, count)
+            manifests[unique_name] = manifest
+    return manifests
+
+def convert_manifest(job):
+    """Given a job tuple of (variable name, manifest path, output header path,
+    top level key, output format, map type), write the header holding the
+    AnyMap representation of the manifest. Return a tuple of (variable name,
+    seconds taken, error message or None). Runs in a worker process.
+    """
+    name, manifest, header, key, output_format, map_type = job
+    start = time.time()
+    try:
+        with open(manifest) as f:
+            json_str = f.read()
+        with open(header, 'w') as out:
+            out.write('#pragma once\n\n')
+            write_preamble(out, map_type)
+            if output_format == 'shared':
+                write_shared_anymap_definitions(out, OrderedDict([(name, json_str)]),
+                                                key, 2, name + '_shared_', map_type)
+            elif output_format == 'flat':
+                out.write(flat_loader)
+                write_flat_anymap_definition(out, name, json_str, key, map_type)
+            else:
+                write_anymap_definition(out, name, json_str, key, 2, map_type)
+    except Exception as e:
+        if os.path.exists(header):
+            os.remove(header)
+        return name, time.time() - start, '%s: %s' % (type(e).__name__, e)
+    return name, time.time() - start, None
+
+def convert_manifests(manifests, output_dir, key=None, jobs=None,
+                      output_format='nested', map_type=None):
+    """Given an OrderedDict of variable names to manifest paths as returned
+    by find_manifests, convert every manifest into its own header in
+    output_dir using a pool of "jobs" worker processes (one per core by default).
+    The output_format is 'nested' for nested initializers, 'shared' to generate
+    identical subtrees within a manifest once, or 'flat' for flat tables.
+    Json objects are generated as the given map_type.
+    Return an OrderedDict with keys = variable names and values =
+    (header path, seconds taken, error message or None), in input order.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    work = [(name, manifest, os.path.join(output_dir, name + '.hpp'), key,
+             output_format, map_type)
+            for name, manifest in manifests.iteritems()]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = dict((name, (seconds, error)) for name, seconds, error
+                       in pool.imap_unordered(convert_manifest, work))
+    finally:
+        pool.close()
+        pool.join()
+    return OrderedDict((job[0], (job[2],) + results[job[0]]) for job in work)
+
+def write_index(out, results, index_dir):
+    """Write a header including every successfully generated header in
+    results, as returned by convert_manifests, to the file-like object "out".
+    The headers are included relative to index_dir, the directory of the
+    index header.
+    """
+    out.write('#pragma once\n\n')
+    for name, (header, seconds, error) in results.iteritems():
+        if error is None:
+            include = os.path.relpath(os.path.abspath(header), os.path.abspath(index_dir))
+            out.write('#include "%s"\n' % include.replace(os.sep, '/'))
+
+if __name__ == "__main__":
+    # Invoke like so:
+    # python ManifestsToAnyMap.py [-j <jobs>] [-k <key>] [-i <index_hpp>] [-s | -f]
+    #                             [-m <map_type>] [-v <schema_json>]
+    #                             <output_dir> <manifest_file_or_dir>...
+    # Every manifest.json found below the given directories, and every
+    # manifest file given explicitly, is written to its own header in
+    # output_dir. The index header (AnyMapManifests.hpp in output_dir by
+    # default) includes all of them. With -s, identical subtrees within a
+    # manifest are generated only once as shared constants. With -f,
+    # manifests are generated as flat constexpr tables, which are loaded into
+    # AnyMap objects at runtime, instead of nested initializers. With -m, json
+    # objects are generated as cppmicroservices::AnyMap objects of the given
+    # any_map::map_type instead of std::map objects. With -v, every manifest
+    # is validated against the json schema (e.g. schemas/manifest_schema.json)
+    # first, which requires the jsonschema package. If any of them is invalid,
+    # the errors are reported and no header is written.
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hj:k:i:sfm:v:")
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    jobs = None
+    key = None
+    index_path = None
+    output_format = 'nested'
+    map_type = None
+    schema_path = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt == '-j':
+            jobs = int(arg)
+        elif opt == '-k':
+            key = arg
+        elif opt == '-i':
+            index_path = arg
+        elif opt == '-s':
+            output_format = 'shared'
+        elif opt == '-f':
+            output_format = 'flat'
+        elif opt == '-m':
+            if arg not in map_types:
+                print usage
+                sys.exit(2)
+            map_type = arg
+        elif opt == '-v':
+            schema_path = arg
+    if len(args) < 2:
+        print usage
+        sys.exit(2)
+    output_dir = args[0]
+    if index_path is None:
+        index_path = os.path.join(output_dir, 'AnyMapManifests.hpp')
+
+    start = time.time()
+    manifests = find_manifests(args[1:])
+    if schema_path:
+        jsondict = OrderedDict()
+        for name, manifest in manifests.iteritems():
+            with open(manifest, 'rb') as f:
+                jsondict[name] = f.read()
+        errors = validate_manifests(jsondict, schema_path,
+                                    dict((name, (manifest, 0))
+                                         for name, manifest in manifests.iteritems()))
+        for error in errors:
+            print >> sys.stderr, error
+        if errors:
+            sys.exit(1)
+    results = convert_manifests(manifests, output_dir, key, jobs,
+                                output_format, map_type)
+    with open(index_path, 'w') as index:
+        write_index(index, results, os.path.dirname(index_path) or os.curdir)
+
+    failed = 0
+    for name, (header, seconds, error) in results.iteritems():
+        if error is None:
+            print '%8.1fms  %s -> %s' % (seconds * 1000, manifests[name], header)
+        else:
+            failed += 1
+            print '%8.1fms  %s FAILED (%s)' % (seconds * 1000, manifests[name], error)
+    print '%d manifests, %d failed, %.3fs total' % (len(results), failed,
+                                                    time.time() - start)
+    if failed:
+        sys.exit(1)
@@ -22,50 +22,411 @@
  =============================================================================*/
  """
 
+import filecmp
+import getopt
+import glob
+import hashlib
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
 import sys
+import tempfile
 from collections import OrderedDict
-from JsonToAnyMap import get_anymap_declaration
+import JsonToAnyMap
+from JsonToAnyMap import check_manifests, flat_loader, map_types, validate_manifests, \
+    write_anymap_definition, write_flat_anymap_definition, write_preamble, write_shared_anymap_definitions
 
-def get_json_dict(f):
-    """Parse each line of TestCodegenerator.cpp and return a dict
-    with keys = name of the variable containing the string representation
-    of the json in TestCodegenerator.cpp
-    and values = the json in string format.
+usage = ('TestCodegenToAnyMap.py [-c <cache_dir> | -s] [-f] [-m <map_type>] [-n <shards> [-z]] '
+         '[-u] [-d <depfile>] [-j <jobs>] [-v <schema_json>] '
+         '<path_to_codegen_cpp>... <output_hpp_file>')
+
+# A std::string constant initialized with a raw string literal. The json is
+# everything between the line break after the opening delimiter and the
+# indentation of the line holding the closing one. Only json objects with an
+# "scr" key are manifests, other raw string literals are skipped.
+manifest_literal = re.compile(
+    r'const\s+std::string\s+(?P<name>\w+)\s*=\s*'
+    r'R"(?P<delim>[^\s()\\"]{0,16})\((?:\r?\n)?'
+    r'(?P<json>.*?)(?:^[ \t]*)?\)(?P=delim)"',
+    re.DOTALL | re.MULTILINE)
+manifest_json = re.compile(r'\s*\{.*"scr"\s*:', re.DOTALL)
+
+def extract_manifests(path):
+    """Given the path of a C++ source, Return a list of tuples of
+    (variable name, start offset, end offset, json) for every std::string
+    constant initialized with a raw string literal holding a manifest in it,
+    in source order.
+    The offsets delimit the json in the file, so it can be located again
+    without scanning the file. The file is memory-mapped and scanned with
+    a single regular expression pass.
     """
-    is_line_json = False
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return [(match.group('name'), match.start('json'), match.end('json'),
+                     match.group('json'))
+                    for match in manifest_literal.finditer(source)
+                    if manifest_json.match(match.group('json'))]
+        finally:
+            source.close()
+
+def find_sources(patterns):
+    """Given a list of paths or glob patterns, Return the list of matching
+    paths, each pattern's matches sorted, without duplicates. Paths not
+    matching any file are kept, so opening them reports the error.
+    """
+    paths = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if path not in paths:
+                paths.append(path)
+    return paths
+
+def get_json_dict(paths, jobs=None, locations=None):
+    """Given the path of TestCodegenerator.cpp, or a list of paths of C++
+    sources, Return a dict with keys = name of the variable containing the
+    string representation of the json and values = the json in string format.
+    Names occurring in more than one source get a numeric suffix.
+    Sources are scanned in parallel by a pool of "jobs" worker processes
+    (one per core by default) when there is more than one.
+    If the dict "locations" is given, it is filled with keys = the variable
+    names and values = (source path, start offset, end offset) of the json.
+    """
+    if isinstance(paths, basestring):
+        paths = [paths]
+    if len(paths) > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            extracted = pool.map(extract_manifests, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        extracted = [extract_manifests(path) for path in paths]
     jsondict = OrderedDict()
-    for line in open(f):
-        if line.startswith('  const std::string'):
-            is_line_json = True
-            cppvarname = line.strip().split()[2]
-            jsondict[cppvarname] = []
-            continue
-        if line.startswith('  )manifest'):
-            is_line_json = False
-        if is_line_json:
-            jsondict[cppvarname].append(line)
-    for key, val in jsondict.iteritems():
-        jsondict[key] = ''.join(val)
+    for path, manifests in zip(paths, extracted):
+        for name, start, end, json_str in manifests:
+            unique_name = name
+            count = 1
+            while unique_name in jsondict:
+                count += 1
+                unique_name = '%s_%d' % (name, count)
+            jsondict[unique_name] = json_str
+            if locations is not None:
+                locations[unique_name] = (path, start, end)
     return jsondict
 
+def generator_version():
+    """Return a hash of the generator sources. It is part of every cache key,
+    so cached fragments are never reused across generator changes.
+    """
+    source = os.path.splitext(JsonToAnyMap.__file__)[0] + '.py'
+    sha = hashlib.sha1()
+    for path in (source, os.path.abspath(__file__)):
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def write_definitions(out, jsondict, cache_dir=None, map_type=None, flat=False,
+                      used=None):
+    """Write the AnyMap definition of every json in jsondict, as returned by
+    get_json_dict, to the file-like object "out", with json objects generated
+    as the given map_type. If flat is True, the definitions are written as
+    flat tables for the flat_loader instead of nested initializers.
+    If cache_dir is given, each definition is stored there in a file named by
+    a hash of the variable name, the json, the output format and the generator
+    version, and is copied from that file instead of being regenerated as long
+    as none of them change. The names of the cache files used are added to the
+    set "used"; if it is not given, cache files not used by this call are
+    removed afterwards.
+    Return a tuple of (cache hits, cache misses).
+    """
+    if flat:
+        write = lambda f, key, val: write_flat_anymap_definition(f, key, val, "scr", map_type)
+    else:
+        write = lambda f, key, val: write_anymap_definition(f, key, val, "scr", 2, map_type)
+    if cache_dir is None:
+        for key, val in jsondict.iteritems():
+            write(out, key, val)
+        return 0, len(jsondict)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    version = generator_version()
+    evict = used is None
+    if evict:
+        used = set()
+    hits = 0
+    for key, val in jsondict.iteritems():
+        sha = hashlib.sha1(version)
+        sha.update('%s %s' % (map_type, flat))
+        sha.update('\0')
+        sha.update(key)
+        sha.update('\0')
+        sha.update(val)
+        fragment = sha.hexdigest() + '.hpp'
+        fragment_path = os.path.join(cache_dir, fragment)
+        used.add(fragment)
+        if os.path.exists(fragment_path):
+            hits += 1
+        else:
+            with open(fragment_path + '.tmp', 'w') as f:
+                write(f, key, val)
+            os.rename(fragment_path + '.tmp', fragment_path)
+        with open(fragment_path) as f:
+            shutil.copyfileobj(f, out)
+    if evict:
+        evict_cache(cache_dir, used)
+    return hits, len(jsondict) - hits
+
+# Names of the files write_definitions stores in the cache directory
+cache_fragment = re.compile(r'^[0-9a-f]{40}\.hpp(\.tmp)?$')
+
+def evict_cache(cache_dir, used):
+    """Remove every cached definition in cache_dir whose name is not in the
+    set "used". Other files in cache_dir are left alone.
+    """
+    for fragment in os.listdir(cache_dir):
+        if cache_fragment.match(fragment) and fragment not in used:
+            os.remove(os.path.join(cache_dir, fragment))
+
+def assign_shards(jsondict, shards, by_size=False):
+    """Split jsondict, as returned by get_json_dict, into a list of "shards"
+    OrderedDicts. By default every json is assigned by a hash of its variable
+    name, so adding or removing a manifest does not move any other one to a
+    different shard. If by_size is True, the jsons are assigned largest first
+    to the shard with the smallest total json size so far instead.
+    Both assignments only depend on the input, and every shard keeps the
+    input order.
+    """
+    if by_size:
+        sizes = [0] * shards
+        shard_of = {}
+        for key in sorted(jsondict, key=lambda key: (-len(jsondict[key]), key)):
+            shard = sizes.index(min(sizes))
+            sizes[shard] += len(jsondict[key])
+            shard_of[key] = shard
+    else:
+        shard_of = dict((key, int(hashlib.md5(key).hexdigest(), 16) % shards)
+                        for key in jsondict)
+    result = [OrderedDict() for _ in range(shards)]
+    for key, val in jsondict.iteritems():
+        result[shard_of[key]][key] = val
+    return result
+
+def shard_path(output_path, shard):
+    """Return the path of the given shard of the output file output_path."""
+    return '%s_%d.cpp' % (os.path.splitext(output_path)[0], shard)
+
+def remove_stale_shards(output_path, shards):
+    """Remove the shard files of output_path left by an earlier run with more
+    than "shards" shards, so a glob-based build does not pick them up.
+    Return the list of removed paths.
+    """
+    stem = os.path.splitext(output_path)[0]
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r'_(\d+)\.cpp$')
+    removed = []
+    for path in glob.glob(stem + '_*.cpp'):
+        match = pattern.match(os.path.basename(path))
+        if match and int(match.group(1)) >= shards:
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+def write_declarations(out, jsondict, map_type=None):
+    """Write a header declaring the constants the definitions of jsondict,
+    as returned by get_json_dict, are written to as extern to the file-like
+    object "out".
+    """
+    out.write('#pragma once\n\n')
+    write_preamble(out, map_type)
+    for key in jsondict:
+        out.write('extern const %s %s;\n' % (map_types[map_type][2], key))
+
+def write_output(path, update_only, write):
+    """Call write with the file-like object the output file "path" is
+    written to. If update_only is True, the output is written to a temporary
+    file first and only replaces "path" if the content changed.
+    """
+    if update_only:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        out = os.fdopen(fd, 'w')
+    else:
+        out = open(path, 'w')
+    try:
+        try:
+            write(out)
+        finally:
+            out.close()
+    except BaseException:
+        if update_only:
+            os.remove(tmp_path)
+        raise
+    if update_only:
+        replace_if_changed(tmp_path, path)
+
+def replace_if_changed(tmp_path, path):
+    """Move the file tmp_path to path, unless path already has the same
+    content, in which case tmp_path is removed and path keeps its mtime.
+    Return True if path was replaced.
+    """
+    if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+        os.remove(tmp_path)
+        return False
+    # The temporary file is only accessible by its owner
+    if os.path.exists(path):
+        shutil.copymode(path, tmp_path)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:
+        # os.rename cannot overwrite an existing file on Windows
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    return True
+
+def write_depfile(depfile, targets, dependencies):
+    """Write a Make/Ninja style depfile stating that every path in targets
+    depends on every path in dependencies.
+    """
+    escape = lambda path: path.replace('\\', '/').replace(' ', '\\ ')
+    with open(depfile, 'w') as f:
+        f.write(' '.join(escape(target) for target in targets) + ':')
+        for dependency in dependencies:
+            f.write(' \\\n  ' + escape(dependency))
+        f.write('\n')
+
 if __name__ == "__main__":
     # Invoke like so:
-    # python TestCodegenToAnyMap <path_to_codegen_cpp> <output_hpp_file>
-    # First argument is path of TestCodegenerator.cpp
-    # Second argument is the output file to write to.
-    testcodegen_path = sys.argv[1]
-    jsondict = get_json_dict(testcodegen_path)
-
-    cpp_path = open(sys.argv[2], 'w')
-    cpp_path.write('#include <map>\n')
-    cpp_path.write('#include <string>\n')
-    cpp_path.write('#include <vector>\n')
-    cpp_path.write('#include "cppmicroservices/Any.h"\n\n')
-    cpp_path.write('using cppmicroservices::Any;\n\n')
-    for key, val in jsondict.iteritems():
-        cpp_path.write('/*\n')
-        cpp_path.write(val)
-        cpp_path.write('*/\n')
-        cpp_path.write('const std::map<std::string, Any> ' + key + ' =\n')
-        cpp_path.write(get_anymap_declaration(val, "scr", 2))
-        cpp_path.write(';\n\n')
+    # python TestCodegenToAnyMap [options] <path_to_codegen_cpp>... <output_hpp_file>
+    # First arguments are paths of TestCodegenerator.cpp or other C++ sources
+    # holding manifests, or glob patterns matching them. With -j, they are
+    # scanned by <jobs> worker processes (one per core by default).
+    # Last argument is the output file to write to.
+    # With -c, generated definitions are cached in cache_dir and reused
+    # for manifests that did not change since the previous run.
+    # With -s, identical subtrees of all manifests are generated only once
+    # as shared constants. Sharing spans all blocks, so -c is ignored.
+    # With -f, manifests are generated as flat constexpr tables, which are
+    # loaded into AnyMap objects at runtime, instead of nested initializers.
+    # It cannot be combined with -s.
+    # With -m, json objects are generated as cppmicroservices::AnyMap objects
+    # of the given any_map::map_type instead of std::map objects.
+    # With -n, the definitions are split into <shards> translation units
+    # named like the output file with the shard number appended and the .cpp
+    # extension, and the output file only declares them. Definitions are
+    # assigned to shards by a hash of their name or, with -z, by size.
+    # Shard files of an earlier run beyond the current number of shards, or
+    # all of them without -n, are removed.
+    # With -u, the output file is only replaced if its content changed, so
+    # its mtime does not trigger needless recompiles.
+    # With -d, a depfile listing the inputs of the output files is written.
+    # With -v, every manifest is validated against the json schema
+    # (e.g. schemas/manifest_schema.json) first, which requires the jsonschema
+    # package. Errors are reported with the line of the source they occur on
+    # and no output file is written. Without -v, manifests which are not
+    # valid json are reported the same way.
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:sfm:n:zud:j:v:")
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    cache_dir = None
+    share = False
+    flat = False
+    map_type = None
+    shards = None
+    by_size = False
+    update_only = False
+    depfile = None
+    jobs = None
+    schema_path = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt == '-c':
+            cache_dir = arg
+        elif opt == '-s':
+            share = True
+        elif opt == '-f':
+            flat = True
+        elif opt == '-m':
+            if arg not in map_types:
+                print usage
+                sys.exit(2)
+            map_type = arg
+        elif opt == '-n':
+            if not arg.isdigit():
+                print usage
+                sys.exit(2)
+            shards = int(arg)
+        elif opt == '-z':
+            by_size = True
+        elif opt == '-u':
+            update_only = True
+        elif opt == '-d':
+            depfile = arg
+        elif opt == '-j':
+            jobs = int(arg)
+        elif opt == '-v':
+            schema_path = arg
+    if len(args) < 2 or (share and flat) or (shards is not None and shards < 1):
+        print usage
+        sys.exit(2)
+    testcodegen_paths = find_sources(args[:-1])
+    locations = {}
+    jsondict = get_json_dict(testcodegen_paths, jobs, locations)
+    if schema_path:
+        errors = validate_manifests(jsondict, schema_path, locations)
+    else:
+        errors = check_manifests(jsondict, locations)
+    for error in errors:
+        print >> sys.stderr, error
+    if errors:
+        sys.exit(1)
+
+    output_path = args[-1]
+    used = set()
+
+    def definitions_writer(jsondict, prefix, include=None):
+        def write(out):
+            if include:
+                out.write('#include "%s"\n\n' % include)
+            else:
+                write_preamble(out, map_type)
+            if flat:
+                out.write(flat_loader)
+            if share:
+                write_shared_anymap_definitions(out, jsondict, "scr", 2, prefix, map_type)
+            else:
+                write_definitions(out, jsondict, cache_dir, map_type, flat, used)
+        return write
+
+    outputs = [output_path]
+    if shards is None:
+        write_output(output_path, update_only,
+                     definitions_writer(jsondict, 'anymap_shared_'))
+    else:
+        write_output(output_path, update_only,
+                     lambda out: write_declarations(out, jsondict, map_type))
+        for shard, shard_dict in enumerate(assign_shards(jsondict, shards, by_size)):
+            outputs.append(shard_path(output_path, shard))
+            write_output(outputs[-1], update_only,
+                         definitions_writer(shard_dict, 'anymap_shared_%d_' % shard,
+                                            os.path.basename(output_path)))
+    remove_stale_shards(output_path, shards or 0)
+    if cache_dir is not None and not share:
+        evict_cache(cache_dir, used)
+
+    if depfile:
+        generator = os.path.splitext(os.path.abspath(JsonToAnyMap.__file__))[0] + '.py'
+        write_depfile(depfile, outputs,
+                      testcodegen_paths + [generator, os.path.abspath(__file__)])
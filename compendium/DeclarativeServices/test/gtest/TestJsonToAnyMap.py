@@ -0,0 +1,349 @@
+"""
+/*=============================================================================
+
+ Library: CppMicroServices
+
+ Copyright (c) The CppMicroServices developers. See the COPYRIGHT
+ file at the top-level directory of this distribution and at
+ https://github.com/CppMicroServices/CppMicroServices/COPYRIGHT .
+
+ Licensed under the Apache License, Version 2.0 (the "License");
+ you may not use this file except in compliance with the License.
+ You may obtain a copy of the License at
+
+ http://www.apache.org/licenses/LICENSE-2.0
+
+ Unless required by applicable law or agreed to in writing, software
+ distributed under the License is distributed on an "AS IS" BASIS,
+ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ See the License for the specific language governing permissions and
+ limitations under the License.
+
+ =============================================================================*/
+ """
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from StringIO import StringIO
+from collections import OrderedDict
+from JsonToAnyMap import check_manifests, find_shared_subtrees, flatten_anymap, \
+    generate_anymap, get_json_node, get_json_offset, get_json_string, lookahead, \
+    write_flat_anymap_definition
+from ManifestsToAnyMap import find_manifests, write_index
+from TestCodegenToAnyMap import assign_shards, evict_cache, get_json_dict, remove_stale_shards, \
+    replace_if_changed, shard_path
+
+manifest = """
+{
+  "scr" : { "version" : 1,
+            "components": [{
+              "implementation-class": "DSSpellCheck::SpellCheckImpl",
+              "activate" : "Activate",
+              "inject-references" : true,
+              "properties": {},
+              "service": {
+                "scope": "SINGLETON",
+                "interfaces": ["SpellCheck::ISpellCheckService", "Foo::Bar"]
+              },
+              "references": [{
+                "name": "dictionary",
+                "interface": "DictionaryService::IDictionaryService",
+                "policy": "dynamic"
+              }, []]
+            }]
+          }
+}
+"""
+
+def generate_anymap_recursive(node, level):
+    """The original recursive emitter, kept as the reference the
+    stack-based generate_anymap must reproduce byte for byte.
+    """
+    if type(node) == OrderedDict:
+        yield 'std::map<std::string, Any> ({\n'
+        for dictitem, has_more in lookahead(node.iteritems()):
+            key, val = dictitem
+            yield '  ' * (level + 1)
+            yield '{{ "{0}", Any('.format(key)
+            for line in generate_anymap_recursive(val, level + 1):
+                yield line
+            if has_more:
+                yield ')},'
+            else:
+                yield ')}'
+            yield '\n'
+        yield '  ' * level
+        yield '})'
+    elif type(node) == types.ListType:
+        yield 'std::vector<Any> {\n'
+        for elem, has_more in lookahead(node):
+            yield '  ' * (level + 1)
+            for line in generate_anymap_recursive(elem, level + 1):
+                yield line
+            if has_more:
+                yield ','
+            yield '\n'
+        yield '  ' * level
+        yield '}'
+    elif type(node) == types.IntType:
+        yield str(node)
+    elif type(node) == types.BooleanType:
+        yield 'true' if node else 'false'
+    elif type(node) == types.StringType or type(node) == types.UnicodeType:
+        yield 'std::string("{0}")'.format(node)
+
+def random_node(rng, depth):
+    """Return a random json node of at most the given depth."""
+    kind = rng.randint(0, 5 if depth > 0 else 2)
+    if kind == 0:
+        return rng.randint(-1000, 1000)
+    if kind == 1:
+        return rng.random() < 0.5
+    if kind == 2:
+        return u'str%d' % rng.randint(0, 100)
+    if kind == 3:
+        return [random_node(rng, depth - 1) for _ in range(rng.randint(0, 4))]
+    node = OrderedDict()
+    for i in range(rng.randint(0, 4)):
+        node[u'key%d' % i] = random_node(rng, depth - 1)
+    return node
+
+class TestGenerateAnyMap(unittest.TestCase):
+
+    def assertSameOutput(self, node, level=0):
+        self.assertEqual(''.join(generate_anymap(node, level)),
+                         ''.join(generate_anymap_recursive(node, level)))
+
+    def test_manifest(self):
+        for key in ('scr', None):
+            expected = ''.join(generate_anymap_recursive(
+                get_json_node(manifest, key), 0))
+            self.assertEqual(get_json_string(manifest, key), expected)
+
+    def test_random_trees(self):
+        rng = random.Random(42)
+        for _ in range(500):
+            self.assertSameOutput(random_node(rng, 6), rng.randint(0, 3))
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 2
+        node = 1
+        for i in range(depth):
+            node = [node] if i % 2 else OrderedDict([(u'k', node)])
+        output = ''.join(generate_anymap(node, 0))
+        self.assertEqual(output.count('Any(1)'), 1)
+        self.assertEqual(output.count('std::vector<Any>'), depth // 2)
+
+    def test_map_type(self):
+        node = get_json_node('{"a": {"b": 1}}')
+        self.assertEqual(''.join(generate_anymap(node, 0, map_type='UNORDERED_MAP')),
+                         'AnyMap(any_map::unordered_any_map({\n'
+                         '  { "a", Any(AnyMap(any_map::unordered_any_map({\n'
+                         '    { "b", Any(1)}\n'
+                         '  })))}\n'
+                         '}))')
+
+class TestSharedSubtrees(unittest.TestCase):
+
+    def test_find_shared_subtrees(self):
+        nodes = [get_json_node(manifest, 'scr'), get_json_node(manifest, 'scr')]
+        subtrees, shared = find_shared_subtrees(nodes, 'shared_')
+        # Only the identical roots are shared, not their nested subtrees
+        self.assertEqual(subtrees, [('shared_0', nodes[0])])
+        self.assertEqual(shared, {id(nodes[0]): 'shared_0',
+                                  id(nodes[1]): 'shared_0'})
+
+    def test_generate_shared(self):
+        node = get_json_node('{"a": {"x": [1]}, "b": {"x": [1]}, "c": [1]}')
+        subtrees, shared = find_shared_subtrees([node], 'shared_')
+        # [1] is used by the shared {"x": [1]} and by "c", so it is shared too
+        self.assertEqual([name for name, subtree in subtrees],
+                         ['shared_0', 'shared_1'])
+        self.assertEqual(''.join(generate_anymap(subtrees[1][1], 0, shared)),
+                         'std::map<std::string, Any> ({\n'
+                         '  { "x", Any(shared_0)}\n'
+                         '})')
+        self.assertEqual(''.join(generate_anymap(node, 0, shared)),
+                         'std::map<std::string, Any> ({\n'
+                         '  { "a", Any(shared_1)},\n'
+                         '  { "b", Any(shared_1)},\n'
+                         '  { "c", Any(shared_0)}\n'
+                         '})')
+
+class TestFlatAnyMap(unittest.TestCase):
+
+    def test_flatten_anymap(self):
+        node = get_json_node('{"name": "a", "list": [1, true, "name"], "map": {}}')
+        rows, pool = flatten_anymap(node)
+        self.assertEqual(pool, 'namealistmap')
+        self.assertEqual(rows, [(0, -1, 0, 0, 0, 0),
+                                (2, 0, 0, 4, 4, 1),
+                                (1, 0, 5, 4, 0, 0),
+                                (3, 2, 0, 0, 1, 0),
+                                (4, 2, 0, 0, 1, 0),
+                                (2, 2, 0, 0, 0, 4),
+                                (0, 0, 9, 3, 0, 0)])
+
+    def test_flatten_long_long(self):
+        rows, pool = flatten_anymap(get_json_node('[2147483647, 2147483648, -2147483649]'))
+        self.assertEqual([row[0] for row in rows], [1, 3, 5, 5])
+        self.assertRaises(ValueError, flatten_anymap, get_json_node('[9223372036854775808]'))
+
+    def test_non_object(self):
+        for json_str in ('{"scr": ""}', '{"scr": [1]}'):
+            with self.assertRaisesRegexp(ValueError, '^manifest_empty_scr: '):
+                write_flat_anymap_definition(StringIO(), 'manifest_empty_scr', json_str, 'scr')
+
+class TestJsonOffset(unittest.TestCase):
+
+    def test_get_json_offset(self):
+        json_str = ' {"a": [1, {"b" : "x"}], "b": {}}'
+        self.assertEqual(get_json_offset(json_str, []), 1)
+        self.assertEqual(get_json_offset(json_str, ['a']), 7)
+        self.assertEqual(get_json_offset(json_str, ['a', 1, 'b']), 18)
+        self.assertEqual(get_json_offset(json_str, ['b']), 30)
+        # Missing steps resolve to the deepest value found
+        self.assertEqual(get_json_offset(json_str, ['a', 2]), 7)
+        self.assertEqual(get_json_offset(json_str, ['a', 0, 'c']), 8)
+
+class TestExtractManifests(unittest.TestCase):
+
+    def test_get_json_dict(self):
+        source = ('namespace {\n'
+                  '    const std::string a = R"manifest(\n'
+                  '    {"scr": 1}\n'
+                  '    )manifest";\n'
+                  '  const std::string b=R"json({"scr": [")"]})json";\n'
+                  '  const std::string c = "not a manifest";\n'
+                  '}\n')
+        fd, path = tempfile.mkstemp(suffix='.cpp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+            locations = {}
+            jsondict = get_json_dict([path, path], 2, locations)
+            self.assertEqual(jsondict.items(), [('a', '    {"scr": 1}\n'),
+                                                ('b', '{"scr": [")"]}'),
+                                                ('a_2', '    {"scr": 1}\n'),
+                                                ('b_2', '{"scr": [")"]}')])
+            for name, (source_path, start, end) in locations.iteritems():
+                self.assertEqual(source[start:end], jsondict[name])
+        finally:
+            os.remove(path)
+
+    def test_check_manifests(self):
+        source = ('const std::string code = R"(int main() {})";\n'
+                  'const std::string good = R"({"scr": {}})";\n'
+                  'const std::string bad = R"(\n'
+                  '{\n'
+                  '  "scr": { "version" 1 }\n'
+                  '})";\n')
+        fd, path = tempfile.mkstemp(suffix='.cpp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+            locations = {}
+            jsondict = get_json_dict(path, locations=locations)
+            self.assertEqual(jsondict.keys(), ['good', 'bad'])
+            errors = check_manifests(jsondict, locations)
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(errors[0].startswith('%s:5: bad: invalid json: ' % path),
+                            errors[0])
+        finally:
+            os.remove(path)
+
+class TestCache(unittest.TestCase):
+
+    def test_evict_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            names = ['a' * 40 + '.hpp', 'b' * 40 + '.hpp', 'c' * 40 + '.hpp.tmp',
+                     'notes.txt']
+            for name in names:
+                open(os.path.join(cache_dir, name), 'w').close()
+            evict_cache(cache_dir, set([names[0]]))
+            self.assertEqual(sorted(os.listdir(cache_dir)), [names[0], 'notes.txt'])
+        finally:
+            shutil.rmtree(cache_dir)
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.output_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_assign_shards(self):
+        jsondict = OrderedDict(('m%d' % i, '{}' + ' ' * i) for i in range(10))
+        for by_size in (False, True):
+            shards = assign_shards(jsondict, 3, by_size)
+            self.assertEqual(len(shards), 3)
+            self.assertEqual(sorted(key for shard in shards for key in shard),
+                             sorted(jsondict))
+            for shard in shards:
+                self.assertEqual(shard.keys(), [key for key in jsondict if key in shard])
+            self.assertEqual(assign_shards(jsondict, 3, by_size), shards)
+        # Largest first to the smallest shard
+        sizes = [sum(len(val) for val in shard.values())
+                 for shard in assign_shards(jsondict, 3, True)]
+        self.assertEqual(sorted(sizes), [21, 22, 22])
+        # Hashing by name does not move the other manifests
+        fewer = OrderedDict(jsondict)
+        del fewer['m0']
+        self.assertEqual([shard.keys() for shard in assign_shards(fewer, 3)],
+                         [[key for key in shard if key != 'm0']
+                          for shard in assign_shards(jsondict, 3)])
+
+    def test_remove_stale_shards(self):
+        output_path = os.path.join(self.output_dir, 'out.hpp')
+        for name in ('out_0.cpp', 'out_1.cpp', 'out_2.cpp', 'out_x.cpp', 'other_3.cpp'):
+            self.write(name, '')
+        self.assertEqual(remove_stale_shards(output_path, 2), [shard_path(output_path, 2)])
+        self.assertEqual(sorted(os.listdir(self.output_dir)),
+                         ['other_3.cpp', 'out_0.cpp', 'out_1.cpp', 'out_x.cpp'])
+        self.assertEqual(sorted(remove_stale_shards(output_path, 0)),
+                         [shard_path(output_path, 0), shard_path(output_path, 1)])
+
+    def test_replace_if_changed(self):
+        path = self.write('out.hpp', 'old')
+        os.utime(path, (0, 0))
+        self.assertFalse(replace_if_changed(self.write('same.tmp', 'old'), path))
+        self.assertEqual(os.path.getmtime(path), 0)
+        self.assertTrue(replace_if_changed(self.write('new.tmp', 'new'), path))
+        with open(path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.output_dir), ['out.hpp'])
+
+class TestFindManifests(unittest.TestCase):
+
+    def test_identifiers(self):
+        root = tempfile.mkdtemp()
+        try:
+            for subdir in ('3rdparty', 'bundle-a'):
+                os.makedirs(os.path.join(root, subdir))
+                open(os.path.join(root, subdir, 'manifest.json'), 'w').close()
+            self.assertEqual(find_manifests([root]).keys(),
+                             ['m_3rdparty_manifest', 'bundle_a_manifest'])
+        finally:
+            shutil.rmtree(root)
+
+    def test_write_index(self):
+        out = StringIO()
+        results = OrderedDict([
+            ('a', (os.path.join('build', 'gen', 'a.hpp'), 0.0, None)),
+            ('b', (os.path.join('build', 'gen', 'b.hpp'), 0.0, 'error'))])
+        write_index(out, results, os.path.join('build', 'include'))
+        self.assertEqual(out.getvalue(), '#pragma once\n\n#include "../gen/a.hpp"\n')
+
+if __name__ == "__main__":
+    unittest.main()
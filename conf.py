@@ -72,6 +72,9 @@ breathe_default_project = "us"
 
 breathe_default_members = ('members', 'protected-members', 'undoc-members')
 
+# Index only the first reference to each CMake object in a document.
+cmake_xref_index_once = True
+
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['doc/_templates']
 
@@ -1,8 +1,11 @@
 # Distributed under the OSI-approved BSD 3-Clause License.  See accompanying
 # file Copyright.txt or https://cmake.org/licensing for details.
 
+import hashlib
+import json
 import os
 import re
+import time
 
 # Monkey patch for pygments reporting an error when generator expressions are
 # used.
@@ -40,7 +43,7 @@ except ImportError:
     # error_reporting was not in utils before version 0.11:
     from docutils.error_reporting import SafeString, ErrorString
 
-from docutils import io, nodes
+from docutils import nodes
 
 from sphinx.directives import ObjectDescription
 from sphinx.domains import Domain, ObjType
@@ -48,6 +51,45 @@ from sphinx.roles import XRefRole
 from sphinx.util.nodes import make_refnode
 from sphinx import addnodes
 
+# Opt-in profiling, enabled by the cmake_profile config value.  Records are
+# kept in env.cmake_profile as docname -> name -> [calls, seconds, bytes read]
+# so they survive parallel reading and are reported at build-finished.
+def _cmake_profile_record(env, docname, name):
+    profile = getattr(env, 'cmake_profile', None)
+    if profile is None:
+        return None
+    return profile.setdefault(docname, {}).setdefault(name, [0, 0.0, 0])
+
+def _cmake_profile_read(env, name, size):
+    record = _cmake_profile_record(env, env.docname, name)
+    if record is not None:
+        record[2] += size
+
+def _cmake_profiled(name, where):
+    """Profile a method if profiling is enabled. where(self, *args) returns
+       the environment and the name of the document being processed.
+    """
+    def decorate(method):
+        def profiled(self, *args, **keys):
+            env, docname = where(self, *args)
+            if getattr(env, 'cmake_profile', None) is None:
+                return method(self, *args, **keys)
+            start = time.time()
+            try:
+                return method(self, *args, **keys)
+            finally:
+                record = _cmake_profile_record(env, docname, name)
+                record[0] += 1
+                record[1] += time.time() - start
+        profiled.__name__ = method.__name__
+        profiled.__doc__ = method.__doc__
+        return profiled
+    return decorate
+
+def _cmake_document_env(transform):
+    env = transform.document.settings.env
+    return env, env.docname
+
 class CMakeModule(Directive):
     required_arguments = 1
     optional_arguments = 0
@@ -58,6 +100,8 @@ class CMakeModule(Directive):
         self.re_start = re.compile(r'^#\[(?P<eq>=*)\[\.rst:$')
         Directive.__init__(self, *args, **keys)
 
+    @_cmake_profiled('CMakeModule.run',
+                     lambda self: _cmake_document_env(self.state))
     def run(self):
         settings = self.state.document.settings
         if not settings.file_insertion_enabled:
@@ -68,23 +112,64 @@ class CMakeModule(Directive):
         path = os.path.normpath(path)
         encoding = self.options.get('encoding', settings.input_encoding)
         e_handler = settings.input_encoding_error_handler
+        # Extracted lines are kept in the environment between builds, keyed
+        # on the path and encoding and checked against the file's mtime and
+        # size, or failing that the digest of the bytes they came from.
+        cache = getattr(env, 'cmake_module_cache', None)
+        if cache is None:
+            cache = env.cmake_module_cache = {}
+        key = (path, encoding)
         try:
             settings.record_dependencies.add(path)
-            f = io.FileInput(source_path=path, encoding=encoding,
-                             error_handler=e_handler)
+            st = os.stat(path)
+            stamp = (st.st_mtime, st.st_size)
+            entry = cache.get(key)
+            if entry is not None and len(entry) != 5:
+                # Stored by an earlier version of this extension
+                entry = None
+            if entry is not None and entry[0] != stamp:
+                _cmake_profile_read(env, 'CMakeModule.run', entry[2])
+                if self.content_unchanged(path, entry):
+                    entry = cache[key] = (stamp,) + entry[1:]
+                else:
+                    entry = None
+            if entry is None:
+                f = open(path, 'rb')
+                try:
+                    entry = (stamp,) + self.extract(f, encoding or 'utf-8-sig',
+                                                    e_handler)
+                finally:
+                    f.close()
+                _cmake_profile_read(env, 'CMakeModule.run', entry[2])
         except UnicodeEncodeError as error:
             raise self.severe('Problems with "%s" directive path:\n'
                               'Cannot encode input file path "%s" '
                               '(wrong locale?).' %
                               (self.name, SafeString(path)))
-        except IOError as error:
+        except (IOError, OSError) as error:
             raise self.severe('Problems with "%s" directive path:\n%s.' %
                       (self.name, ErrorString(error)))
-        raw_lines = f.read().splitlines()
-        f.close()
+        stamp, digest, size, lines, rst = entry
+        if rst is not None and rst != '#':
+            raise self.warning('"%s" found unclosed bracket "#[%s[.rst:" in %s' %
+                               (self.name, rst[1:-1], path))
+        cache[key] = entry
+        self.state_machine.insert_input(list(lines), path)
+        return []
+
+    def extract(self, f, encoding, e_handler):
+        """Extract the documentation blocks from the binary file f. Lines
+           outside of the blocks are kept empty so line numbers still match
+           the file.
+           Return a tuple of the digest and length of the file, the lines
+           and the bracket left open.
+        """
+        data = f.read()
         rst = None
         lines = []
-        for line in raw_lines:
+        # Decoded as a whole, as splitting the bytes would break encodings
+        # like UTF-16 and line endings other than \n
+        for line in data.decode(encoding, e_handler).splitlines():
             if rst is not None and rst != '#':
                 # Bracket mode: check for end bracket
                 pos = line.find(rst)
@@ -112,11 +197,19 @@ class CMakeModule(Directive):
                 elif rst is None:
                     line = ''
             lines.append(line)
-        if rst is not None and rst != '#':
-            raise self.warning('"%s" found unclosed bracket "#[%s[.rst:" in %s' %
-                               (self.name, rst[1:-1], path))
-        self.state_machine.insert_input(lines, path)
-        return []
+        return hashlib.sha1(data).hexdigest(), len(data), tuple(lines), rst
+
+    def content_unchanged(self, path, entry):
+        """Return whether the file a cache entry was extracted from still
+           has the same content.
+        """
+        stamp, digest, size, lines, rst = entry
+        f = open(path, 'rb')
+        try:
+            data = f.read(size + 1)
+        finally:
+            f.close()
+        return len(data) == size and hashlib.sha1(data).hexdigest() == digest
 
 class _cmake_index_entry:
     def __init__(self, desc):
@@ -141,13 +234,32 @@ _cmake_index_objs = {
     'variable':   _cmake_index_entry('variable'),
     }
 
+def _cmake_object_docnames(data):
+    # Environments pickled before the index existed only have 'objects'.
+    docnames = data.get('docnames')
+    if docnames is None:
+        docnames = data['docnames'] = {}
+        for targetid, (docname, objtype) in data['objects'].items():
+            docnames.setdefault(docname, set()).add(targetid)
+    return docnames
+
+def _cmake_set_object(data, targetid, docname, objtype, line):
+    docnames = _cmake_object_docnames(data)
+    old = data['objects'].get(targetid)
+    if old is not None:
+        docnames[old[0]].discard(targetid)
+    data['objects'][targetid] = (docname, objtype)
+    docnames.setdefault(docname, set()).add(targetid)
+    data.setdefault('lines', {})[targetid] = line
+
 def _cmake_object_inventory(env, document, line, objtype, targetid):
-    inv = env.domaindata['cmake']['objects']
+    data = env.domaindata['cmake']
+    inv = data['objects']
     if targetid in inv:
         document.reporter.warning(
             'CMake object "%s" also described in "%s".' %
             (targetid, env.doc2path(inv[targetid][0])), line=line)
-    inv[targetid] = (env.docname, objtype)
+    _cmake_set_object(data, targetid, env.docname, objtype, line)
 
 class CMakeTransform(Transform):
 
@@ -155,35 +267,46 @@ class CMakeTransform(Transform):
     # treated as if they were written in the documents.
     default_priority = 210
 
-    def __init__(self, document, startnode):
-        Transform.__init__(self, document, startnode)
-        self.titles = {}
-
     def parse_title(self, docname):
         """Parse a document title as the first line starting in [A-Za-z0-9<]
            or fall back to the document basename if no such line exists.
            The cmake --help-*-list commands also depend on this convention.
            Return the title or False if the document file does not exist.
+           Titles are kept in the environment across builds until the
+           document file's mtime changes.
         """
         env = self.document.settings.env
-        title = self.titles.get(docname)
-        if title is None:
-            fname = os.path.join(env.srcdir, docname+'.rst')
-            try:
-                f = open(fname, 'r')
-            except IOError:
-                title = False
-            else:
-                for line in f:
-                    if len(line) > 0 and (line[0].isalnum() or line[0] == '<'):
-                        title = line.rstrip()
-                        break
-                f.close()
-                if title is None:
-                    title = os.path.basename(docname)
-            self.titles[docname] = title
+        titles = getattr(env, 'cmake_titles', None)
+        if titles is None:
+            titles = env.cmake_titles = {}
+        fname = os.path.join(env.srcdir, docname+'.rst')
+        try:
+            mtime = os.path.getmtime(fname)
+        except OSError:
+            mtime = None
+        entry = titles.get(docname)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        title = None
+        try:
+            f = open(fname, 'r')
+        except IOError:
+            title = False
+        else:
+            size = 0
+            for line in f:
+                size += len(line)
+                if len(line) > 0 and (line[0].isalnum() or line[0] == '<'):
+                    title = line.rstrip()
+                    break
+            f.close()
+            _cmake_profile_read(env, 'CMakeTransform.apply', size)
+            if title is None:
+                title = os.path.basename(docname)
+        titles[docname] = (mtime, title)
         return title
 
+    @_cmake_profiled('CMakeTransform.apply', _cmake_document_env)
     def apply(self):
         env = self.document.settings.env
 
@@ -233,6 +356,10 @@ class CMakeXRefRole(XRefRole):
     _re = re.compile(r'^(.+?)(\s*)(?<!\x00)<(.*?)>$', re.DOTALL)
     _re_sub = re.compile(r'^([^()\s]+)\s*\(([^()]*)\)$', re.DOTALL)
 
+    # args are lineno, inliner, options and content.
+    @_cmake_profiled('CMakeXRefRole.__call__',
+                     lambda self, typ, rawtext, text, lineno, inliner, *args:
+                     _cmake_document_env(inliner))
     def __call__(self, typ, rawtext, text, *args, **keys):
         # Translate CMake command cross-references of the form:
         #  `command_name(SUB_COMMAND)`
@@ -270,11 +397,15 @@ class CMakeXRefTransform(Transform):
     # after the sphinx (210) and docutils (220) substitutions.
     default_priority = 221
 
+    @_cmake_profiled('CMakeXRefTransform.apply', _cmake_document_env)
     def apply(self):
         env = self.document.settings.env
 
         # Find CMake cross-reference nodes and add index and target
-        # nodes for them.
+        # nodes for them.  With cmake_xref_index_once only the first
+        # reference to each object in a document gets them.
+        once = env.config.cmake_xref_index_once
+        indexed = set()
         for ref in self.document.traverse(addnodes.pending_xref):
             if not ref['refdomain'] == 'cmake':
                 continue
@@ -285,6 +416,10 @@ class CMakeXRefTransform(Transform):
                 continue
 
             objname = ref['reftarget']
+            if once:
+                if (objtype, objname) in indexed:
+                    continue
+                indexed.add((objtype, objname))
             targetnum = env.new_serialno('index-%s:%s' % (objtype, objname))
 
             targetid = 'index-%s-%s:%s' % (targetnum, objtype, objname)
@@ -347,16 +482,35 @@ class CMakeDomain(Domain):
     }
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
+        'docnames': {},  # docname -> set of fullnames
+        'lines': {},  # fullname -> line described on
     }
 
     def clear_doc(self, docname):
-        to_clear = set()
-        for fullname, (fn, _) in self.data['objects'].items():
-            if fn == docname:
-                to_clear.add(fullname)
-        for fullname in to_clear:
+        lines = self.data.get('lines', {})
+        for fullname in _cmake_object_docnames(self.data).pop(docname, ()):
             del self.data['objects'][fullname]
-
+            lines.pop(fullname, None)
+
+    def merge_domaindata(self, docnames, otherdata):
+        # Objects of documents read by other processes were not visible to
+        # the process reading docnames, so duplicates are reported here.
+        read_docs = getattr(self.env, 'cmake_read_docs', ())
+        objects = self.data['objects']
+        other_docnames = _cmake_object_docnames(otherdata)
+        for fn in docnames:
+            for fullname in other_docnames.get(fn, ()):
+                other = objects.get(fullname)
+                line = otherdata.get('lines', {}).get(fullname)
+                if other is not None and other[0] not in docnames and \
+                   other[0] in read_docs:
+                    self.env.warn(fn, 'CMake object "%s" also described in "%s".' %
+                                  (fullname, self.env.doc2path(other[0])), line)
+                _cmake_set_object(self.data, fullname, fn,
+                                  otherdata['objects'][fullname][1], line)
+
+    @_cmake_profiled('CMakeDomain.resolve_xref',
+                     lambda self, env, fromdocname, *args: (env, fromdocname))
     def resolve_xref(self, env, fromdocname, builder,
                      typ, target, node, contnode):
         targetid = '%s:%s' % (typ, target)
@@ -371,8 +525,70 @@ class CMakeDomain(Domain):
         for refname, (docname, type) in self.data['objects'].items():
             yield (refname, refname, type, docname, refname, 1)
 
+def _cmake_before_read_docs(app, env, docnames):
+    env.cmake_read_docs = set(docnames)
+
+def _cmake_merge_info(app, env, docnames, other):
+    for name in ('cmake_module_cache', 'cmake_titles'):
+        data = getattr(other, name, None)
+        if data:
+            if getattr(env, name, None) is None:
+                setattr(env, name, {})
+            getattr(env, name).update(data)
+    profile = getattr(env, 'cmake_profile', None)
+    if profile is not None:
+        other_profile = getattr(other, 'cmake_profile', None) or {}
+        for docname in docnames:
+            if docname in other_profile:
+                profile[docname] = other_profile[docname]
+
+def _cmake_profile_start(app):
+    app.env.cmake_profile = {} if app.config.cmake_profile else None
+
+def _cmake_profile_report(app, exception):
+    profile = getattr(app.env, 'cmake_profile', None)
+    if profile is None:
+        return
+    totals = {}
+    for docname, records in profile.items():
+        for name, record in records.items():
+            total = totals.setdefault(name, [0, 0.0, 0])
+            for i in range(3):
+                total[i] += record[i]
+    app.info('cmake profile (calls, cumulative seconds, bytes read):')
+    for name, (calls, seconds, size) in sorted(totals.items(),
+                                               key=lambda item: -item[1][1]):
+        app.info('  %-26s %8d %10.3fs %12d' % (name, calls, seconds, size))
+    documents = sorted(profile.items(),
+                       key=lambda item: -sum(r[1] for r in item[1].values()))
+    app.info('slowest documents:')
+    for docname, records in documents[:10]:
+        app.info('  %-40s %10.3fs %12d' % (docname,
+                                          sum(r[1] for r in records.values()),
+                                          sum(r[2] for r in records.values())))
+    def fields(record):
+        return {'calls': record[0], 'seconds': record[1], 'bytes': record[2]}
+    path = os.path.join(app.outdir, app.config.cmake_profile)
+    with open(path, 'w') as f:
+        json.dump({'functions': dict((name, fields(total))
+                                     for name, total in totals.items()),
+                   'documents': dict((docname, dict((name, fields(record))
+                                                    for name, record in records.items()))
+                                     for docname, records in profile.items())},
+                  f, indent=2, sort_keys=True)
+    app.info('cmake profile written to %s' % path)
+    app.env.cmake_profile = None
+
 def setup(app):
+    app.add_config_value('cmake_xref_index_once', False, 'env')
+    # File name, relative to the output directory, of the JSON profile.
+    app.add_config_value('cmake_profile', '', '')
     app.add_directive('cmake-module', CMakeModule)
     app.add_transform(CMakeTransform)
     app.add_transform(CMakeXRefTransform)
     app.add_domain(CMakeDomain)
+    app.connect('env-before-read-docs', _cmake_before_read_docs)
+    app.connect('env-merge-info', _cmake_merge_info)
+    app.connect('builder-inited', _cmake_profile_start)
+    app.connect('build-finished', _cmake_profile_report)
+    return {'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -4,7 +4,9 @@
 # required for uploading reports to codecov.io
 
 import xml.etree.ElementTree as xml
-import glob, os, re, sys, getopt
+from xml.sax.saxutils import escape, quoteattr
+from collections import OrderedDict
+import json, multiprocessing, os, re, subprocess, sys, getopt
 
 #----------- Remove prefix from a string -----------
 def remove_prefix(line, prefix):
@@ -13,59 +15,672 @@ def remove_prefix(line, prefix):
     else:
         return line
 
+#----------- Resolve case-insensitive paths to case-sensitive paths -----------
+# Every directory is listed at most once (twice if cached, see lookup) and
+# indexed by lowercase name, and every resolved path prefix is remembered, so
+# resolving many files below the same directories does not walk them again.
+# With a cachefile, the directory indexes are also kept across runs. Each one
+# is stored with a stamp of its directory, the git tree hash from tree_hashes
+# (see gitTreeHashes) if the directory is tracked, its mtime otherwise, and is
+# only reused while the stamp does not change.
+class CasedPathResolver(object):
+    counters = ("hits", "misses", "scanned", "reused")
+
+    def __init__(self, cachefile=None, tree_hashes=None):
+        self.dirs = {}      # actual directory path -> {lowercase name: actual name}
+        self.prefixes = {}  # lowercase path prefix -> actual path prefix
+        self.hits = 0
+        self.misses = 0
+        self.scanned = 0
+        self.reused = 0     # directory indexes taken from the cachefile
+        self.cachefile = cachefile
+        self.tree_hashes = tree_hashes
+        self.cache = {}     # actual directory path -> [stamp, {lowercase name: actual name}]
+        self.updates = {}   # the entries of cache scanned in this run
+        self.stale = set()  # directories indexed from the cachefile, not rescanned yet
+        if cachefile and os.path.exists(cachefile):
+            # An unreadable or corrupt cachefile is ignored and rewritten
+            try:
+                with open(cachefile) as f:
+                    cache = json.load(f)
+            except (IOError, ValueError):
+                cache = None
+            if isinstance(cache, dict) and cache.get("version") == 1 and isinstance(cache.get("dirs"), dict):
+                self.cache = cache["dirs"]
+
+    def stamp(self, directory):
+        if not self.cachefile:
+            return None
+        path = os.path.normcase(os.path.abspath(directory or os.curdir))
+        if self.tree_hashes and path in self.tree_hashes:
+            return "git:" + self.tree_hashes[path]
+        try:
+            return "mtime:%r" % os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def index(self, directory):
+        names = self.dirs.get(directory)
+        if names is None:
+            stamp = self.stamp(directory)
+            cached = self.cache.get(directory)
+            if stamp is not None and cached is not None and cached[0] == stamp:
+                names = cached[1]
+                self.reused += 1
+                self.stale.add(directory)
+            else:
+                names = self.scan(directory, stamp)
+            self.dirs[directory] = names
+        return names
+
+    # Git tree hashes do not change with untracked files and mtimes may be
+    # too coarse, so a name missing from an index taken from the cachefile
+    # rescans its directory once before the name is given up on
+    def lookup(self, directory, name):
+        actual = self.index(directory).get(name.lower())
+        if actual is None and directory in self.stale:
+            self.stale.discard(directory)
+            self.dirs[directory] = self.scan(directory, self.stamp(directory))
+            actual = self.dirs[directory].get(name.lower())
+        return actual
+
+    def scan(self, directory, stamp):
+        # The stamp is taken before listing, so changes while listing invalidate it
+        names = {}
+        try:
+            entries = os.listdir(directory or os.curdir)
+        except OSError:
+            entries = []
+        for entry in entries:
+            names.setdefault(entry.lower(), entry)
+        self.scanned += 1
+        if stamp is not None:
+            self.cache[directory] = self.updates[directory] = [stamp, names]
+        return names
+
+    def save(self):
+        if not self.cachefile or not self.updates:
+            return
+        tmpfile = self.cachefile + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump({"version": 1, "dirs": self.cache}, f)
+        if hasattr(os, "replace"):
+            os.replace(tmpfile, self.cachefile)
+        else:
+            if os.path.exists(self.cachefile):
+                os.remove(self.cachefile)
+            os.rename(tmpfile, self.cachefile)
+
+    # Runs of several separators are kept as they are, like glob did, so
+    # paths built from a <source> ending in a separator, like Z:\\foo from Z:\,
+    # still start with the prefix of the source path
+    def resolve(self, path):
+        unc, p = os.path.splitdrive(path)
+        lead = re.match(r'[/\\]*', p).group(0)
+        actual = unc + lead
+        key = actual.lower()
+        for sep, part in re.findall(r'([/\\]*)([^/\\]+)', p[len(lead):]):
+            key += '/' * len(sep) + part.lower()
+            prefix = self.prefixes.get(key)
+            if prefix is not None:
+                self.hits += 1
+                actual = prefix
+                continue
+            self.misses += 1
+            name = part if part in ('.', '..') else self.lookup(actual, part)
+            if name is None:
+                return path
+            if len(sep) > 1:
+                actual += sep
+            actual = os.path.join(actual, name) if actual else name
+            self.prefixes[key] = actual
+        return actual
+
+    def stats(self):
+        return ("Resolved path prefixes: %d cache hits, %d misses, %d directories scanned, %d cached"
+                % (self.hits, self.misses, self.scanned, self.reused))
+
+#----------- Git tree hashes of the directories of a repository -----------
+# Returns a dict of normalized absolute directory path -> tree hash at HEAD
+# for the git repository containing path, or None if there is none
+def gitTreeHashes(path):
+    try:
+        top = subprocess.check_output(["git", "-C", path, "rev-parse", "--show-toplevel"])
+        top = top.decode("utf-8").strip()
+        root = subprocess.check_output(["git", "-C", top, "rev-parse", "HEAD^{tree}"])
+        listing = subprocess.check_output(["git", "-C", top, "ls-tree", "-r", "-t", "-z", "HEAD"])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    hashes = {os.path.normcase(os.path.abspath(top)): root.decode("utf-8").strip()}
+    for entry in listing.decode("utf-8").split("\0"):
+        if not entry:
+            continue
+        info, name = entry.split("\t", 1)
+        mode, kind, sha = info.split()
+        if kind == "tree":
+            hashes[os.path.normcase(os.path.abspath(os.path.join(top, name)))] = sha
+    return hashes
+
+#----------- Remap paths by rules, without accessing the filesystem -----------
+# Each rule maps a path prefix, or a regular expression if it starts with
+# "re:", to its replacement. Prefixes are matched case-insensitively and with
+# / and \ treated the same, the longest matching prefix wins. They are stored
+# in a trie, so matching a path takes time linear in its length regardless of
+# the number of rules. Regular expressions take priority over prefixes and
+# are tried first, in order; they see / as separator and replacements may
+# refer to their groups. Remapped paths use / as separator, unmatched ones are
+# kept as is.
+class PathRemapper(object):
+    counters = ("matched", "unmatched")
+
+    def __init__(self, rules):
+        self.trie = {}
+        self.patterns = []
+        self.matched = 0
+        self.unmatched = 0
+        for source, target in rules:
+            if source.startswith("re:"):
+                self.patterns.append((re.compile(source[3:]), target))
+                continue
+            node = self.trie
+            for char in source.replace("\\", "/").lower():
+                node = node.setdefault(char, {})
+            node.setdefault(None, target)
+
+    def resolve(self, path):
+        path_key = path.replace("\\", "/")
+        for pattern, target in self.patterns:
+            match = pattern.match(path_key)
+            if match:
+                self.matched += 1
+                return match.expand(target) + path_key[match.end():]
+        lower_key = path_key.lower()
+        node = self.trie
+        end = None
+        for i in range(len(lower_key) + 1):
+            if None in node:
+                end, target = i, node[None]
+            if i == len(lower_key):
+                break
+            node = node.get(lower_key[i])
+            if node is None:
+                break
+        if end is not None:
+            self.matched += 1
+            return target.replace("\\", "/") + path_key[end:]
+        self.unmatched += 1
+        return path
+
+    def save(self):
+        pass
+
+    def stats(self):
+        return "Remapped paths: %d matched, %d unmatched" % (self.matched, self.unmatched)
+
+#----------- Read remapping rules from a file -----------
+# One "<from> => <to>" rule per line, empty lines and lines starting with #
+# are ignored
+def readRules(rulesfile):
+    rules = []
+    with open(rulesfile) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            source, separator, target = line.partition("=>")
+            if not separator:
+                raise ValueError("%s: invalid rule: %s" % (rulesfile, line))
+            rules.append((source.strip(), target.strip()))
+    return rules
+
 #----------- Convert case-insensitive path to case-sensitive path -----------
-def casedpath_unc(path):
-    unc, p = os.path.splitdrive(path)
-    r = glob.glob(unc + re.sub(r'([^:/\\])(?=[/\\]|$)', r'[\1]', p))
-    return r and r[0] or path
+default_resolver = CasedPathResolver()
+
+def casedpath_unc(path, resolver=default_resolver):
+    return resolver.resolve(path)
+
+#----------- Replace the filename of a class with the case sensitive path -----------
+# The result filename is relative to the provided source path
+def fixClassPath(class_elem, source_dir, prefix, resolver):
+    filepath = "%s\%s" % (source_dir,class_elem.attrib['filename'])
+    case_sensitive_filepath = casedpath_unc(filepath, resolver)
+    rel_filepath = remove_prefix(case_sensitive_filepath, prefix)
+    class_elem.attrib['filename'] = rel_filepath
+    class_elem.attrib['name'] = os.path.basename(rel_filepath)
+
+#----------- Prefix to remove from the resolved paths of a report -----------
+# Returns None if the source drive of the report does not match the drive of
+# the provided source path. Remapped paths keep no prefix to remove.
+def sourcePrefix(source_dir, sourcepath, resolver=None):
+    if isinstance(resolver, PathRemapper):
+        return ""
+    actual_src_drive, actual_src_tail = os.path.splitdrive(sourcepath)
+    src_drive, src_tail = os.path.splitdrive(source_dir)
+    if actual_src_drive.lower() != src_drive.lower():
+        return None
+    return src_drive+actual_src_tail+"\\"
 
 #----------------------------------------------------------------------
-def modifyXML(infile, sourcepath, outfile):
+def modifyXML(infile, sourcepath, outfile, resolver=None):
     tree = xml.ElementTree(file=infile)
     root = tree.getroot()
     
     source_dir = root.find('sources/source')
-    actual_src_drive, actual_src_tail = os.path.splitdrive(sourcepath)
-    src_drive, src_tail = os.path.splitdrive(source_dir.text)
-    if actual_src_drive.lower() == src_drive.lower():
+    prefix = sourcePrefix(source_dir.text, sourcepath, resolver)
+    if prefix is not None:
         # Replace the filename with the case sensitive path
         # The result filename is relative to the provided source path
+        if resolver is None:
+            resolver = CasedPathResolver()
         for class_elem in root.iter("class"):
-            filepath = "%s\%s" % (source_dir.text,class_elem.attrib['filename'])
-            case_sensitive_filepath = casedpath_unc(filepath)
-            rel_filepath = remove_prefix(case_sensitive_filepath, src_drive+actual_src_tail+"\\")
-            class_elem.attrib['filename'] = rel_filepath
-            class_elem.attrib['name'] = os.path.basename(rel_filepath)
-        source_dir.text = sourcepath
+            fixClassPath(class_elem, source_dir.text, prefix, resolver)
+        if sourcepath:
+            source_dir.text = sourcepath
         tree = xml.ElementTree(root)
         tree.write(outfile, encoding="utf-8",xml_declaration=True)
+        resolver.save()
+        print(resolver.stats())
     else:
         print("Error: Source drive in input file does not match the provided source path's drive")
         sys.exit(-1)
 
+#----------- Same as modifyXML, but streaming the report -----------
+# Every <source> and <class> element is rewritten and written out as soon as
+# it has been parsed, and then removed from the tree, so memory use does not
+# grow with the size of the report. All other elements are copied tag by tag.
+def modifyXMLStreaming(infile, sourcepath, outfile, resolver=None):
+    if resolver is None:
+        resolver = CasedPathResolver()
+    source_dir = None
+    prefix = None
+    stack = []   # [element, start tag written] of the open elements
+    done = []    # the last element written, until its tail is written
+    depth = 0    # nesting depth inside the <source> or <class> being parsed
+    out = open(outfile, 'wb')
+    write = lambda text: out.write(text.encode('utf-8'))
+
+    def flush():
+        # Write the tail of the previous sibling and the start tag of the parent
+        if done:
+            elem = done.pop()
+            write(escape(elem.tail or ''))
+            if stack:
+                stack[-1][0].remove(elem)
+        if stack and not stack[-1][1]:
+            elem = stack[-1][0]
+            write(start_tag(elem) + escape(elem.text or ''))
+            stack[-1][1] = True
+
+    try:
+        write("<?xml version='1.0' encoding='utf-8'?>\n")
+        for event, elem in xml.iterparse(infile, events=('start', 'end')):
+            if event == 'start':
+                if depth:
+                    depth += 1
+                    continue
+                flush()
+                if elem.tag in ('source', 'class'):
+                    depth = 1
+                else:
+                    stack.append([elem, False])
+                continue
+            if depth:
+                depth -= 1
+                if depth:
+                    continue
+                if elem.tag == 'source' and source_dir is None:
+                    source_dir = elem.text
+                    prefix = sourcePrefix(source_dir, sourcepath, resolver)
+                    if prefix is None:
+                        out.close()
+                        os.remove(outfile)
+                        print("Error: Source drive in input file does not match the provided source path's drive")
+                        sys.exit(-1)
+                    if sourcepath:
+                        elem.text = sourcepath
+                elif elem.tag == 'class':
+                    fixClassPath(elem, source_dir, prefix, resolver)
+                # The parser may already be past the end of the element
+                tail, elem.tail = elem.tail, None
+                out.write(xml.tostring(elem, encoding="utf-8"))
+                elem.tail = tail
+                done.append(elem)
+                continue
+            flush()
+            if stack[-1][1]:
+                write("</%s>" % elem.tag)
+            elif elem.text:
+                write(start_tag(elem) + escape(elem.text) + "</%s>" % elem.tag)
+            else:
+                write(start_tag(elem)[:-1] + " />")
+            stack.pop()
+            done.append(elem)
+    finally:
+        if not out.closed:
+            out.close()
+    resolver.save()
+    print(resolver.stats())
+
+#----------- Serialize the start tag of an element -----------
+def start_tag(elem):
+    attributes = elem.attrib.items()
+    if sys.version_info < (3, 8):
+        # Like ElementTree before Python 3.8
+        attributes = sorted(attributes)
+    return "<%s%s>" % (elem.tag, "".join(" %s=%s" % (name, quoteattr(value))
+                                         for name, value in attributes))
+
+#----------- Read the fixed coverage data of a report -----------
+# Runs in a worker process for every report to merge. Returns the attributes
+# of the <coverage> element, an OrderedDict of package name -> (attributes,
+# list of filenames) and an OrderedDict of filename -> (class attributes,
+# OrderedDict of (name, signature) -> (method attributes, lines), lines),
+# where lines are OrderedDicts of line number -> line attributes, followed
+# by the source directory of the report, the directory indexes scanned and
+# the values of the counters of the resolver.
+def readReport(job):
+    infile, sourcepath, resolver = job
+    if resolver is None:
+        resolver = CasedPathResolver()
+    source_dir = None
+    prefix = None
+    root = None
+    packages = OrderedDict()
+    classes = OrderedDict()
+    for event, elem in xml.iterparse(infile, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            elif elem.tag == 'package':
+                package = packages.setdefault(elem.get('name'), (dict(elem.attrib), []))
+            continue
+        if elem.tag == 'source' and source_dir is None:
+            source_dir = elem.text
+            prefix = sourcePrefix(source_dir, sourcepath, resolver)
+            if prefix is None:
+                raise ValueError("%s: Source drive in input file does not match the provided source path's drive" % infile)
+        elif elem.tag == 'class':
+            fixClassPath(elem, source_dir, prefix, resolver)
+            methods = OrderedDict()
+            for method in elem.findall('methods/method'):
+                key = (method.get('name'), method.get('signature'))
+                mergeLines(methods.setdefault(key, (dict(method.attrib), OrderedDict()))[1],
+                           readLines(method))
+            filename = elem.get('filename')
+            if filename not in classes:
+                package[1].append(filename)
+            mergeClass(classes, filename, (dict(elem.attrib), methods, readLines(elem)))
+            elem.clear()
+        elif elem.tag == 'package':
+            elem.clear()
+    return (dict(root.attrib), packages, classes, source_dir, getattr(resolver, "updates", {}),
+            [getattr(resolver, name) for name in resolver.counters])
+
+def readLines(elem):
+    return OrderedDict((line.get('number'), dict(line.attrib))
+                       for line in elem.findall('lines/line'))
+
+#----------- Union the coverage of lines -----------
+# Hits are added up. Of the branches of a line, the most covered ones win.
+def mergeLines(lines, other):
+    for number, attrib in other.items():
+        line = lines.get(number)
+        if line is None:
+            lines[number] = dict(attrib)
+            continue
+        line['hits'] = str(int(line.get('hits', 0)) + int(attrib.get('hits', 0)))
+        if attrib.get('branch') == 'true':
+            covered, valid = branchCoverage(line)
+            other_covered, other_valid = branchCoverage(attrib)
+            covered, valid = max(covered, other_covered), max(valid, other_valid)
+            line['branch'] = 'true'
+            line['condition-coverage'] = "%d%% (%d/%d)" % (100 * covered // valid if valid else 0,
+                                                          covered, valid)
+
+def mergeClass(classes, filename, data):
+    merged = classes.get(filename)
+    if merged is None:
+        classes[filename] = data
+        return
+    attrib, methods, lines = data
+    for key, (method_attrib, method_lines) in methods.items():
+        mergeLines(merged[1].setdefault(key, (method_attrib, OrderedDict()))[1], method_lines)
+    mergeLines(merged[2], lines)
+
+#----------- Number of covered and valid branches of a line -----------
+def branchCoverage(line):
+    match = re.search(r'\((\d+)/(\d+)\)', line.get('condition-coverage', ''))
+    if line.get('branch') != 'true' or not match:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+#----------- Set the coverage rates of an element from the lines it covers -----------
+# Returns the (covered lines, valid lines, covered branches, valid branches)
+def setRates(elem, lines):
+    counts = [0, 0, 0, 0]
+    for line in lines:
+        counts[0] += int(line.get('hits', 0)) > 0
+        counts[1] += 1
+        covered, valid = branchCoverage(line)
+        counts[2] += covered
+        counts[3] += valid
+    setRatesFromCounts(elem, counts)
+    return counts
+
+def setRatesFromCounts(elem, counts):
+    elem.set('line-rate', "%g" % (float(counts[0]) / counts[1] if counts[1] else 0))
+    elem.set('branch-rate', "%g" % (float(counts[2]) / counts[3] if counts[3] else 0))
+
+#----------- Fix many reports in parallel and merge them into one -----------
+# The merged report is written as Cobertura XML, or in one of the formats
+# of writeLcov and writeJson
+def mergeReports(infiles, sourcepath, outfile, jobs=None, resolver=None, outputformat="cobertura"):
+    jobs_args = [(infile, sourcepath, resolver) for infile in infiles]
+    try:
+        if len(infiles) == 1:
+            reports = [readReport(jobs_args[0])]
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                reports = pool.map(readReport, jobs_args)
+            finally:
+                pool.close()
+                pool.join()
+    except ValueError as e:
+        print("Error: %s" % e)
+        sys.exit(-1)
+
+    # Every file is listed in the first package it occurs in. The statistics
+    # of resolvers used in other processes are added up in summary.
+    summary = resolver if resolver is not None else CasedPathResolver()
+    foreign = resolver is None or len(infiles) > 1
+    packages = OrderedDict()
+    classes = OrderedDict()
+    for root_attrib, report_packages, report_classes, source_dir, updates, counts in reports:
+        if resolver is not None and updates:
+            resolver.cache.update(updates)
+            resolver.updates.update(updates)
+        if foreign:
+            for name, count in zip(summary.counters, counts):
+                setattr(summary, name, getattr(summary, name) + count)
+        for name, (attrib, filenames) in report_packages.items():
+            package = packages.setdefault(name, (attrib, []))
+            for filename in filenames:
+                if filename not in classes:
+                    package[1].append(filename)
+                mergeClass(classes, filename, report_classes[filename])
+
+    if outputformat != "cobertura":
+        with open(outfile, "w") as out:
+            if outputformat == "lcov":
+                writeLcov(out, classes)
+            else:
+                writeJson(out, classes)
+        if resolver is not None:
+            resolver.save()
+        print(summary.stats())
+        print("Converted %d report(s) to %s: %d files" % (len(reports), outputformat, len(classes)))
+        return
+
+    root = xml.Element('coverage', reports[0][0])
+    xml.SubElement(xml.SubElement(root, 'sources'), 'source').text = sourcepath or reports[0][3]
+    packages_elem = xml.SubElement(root, 'packages')
+    totals = [0, 0, 0, 0]
+    for name, (attrib, filenames) in packages.items():
+        if not filenames:
+            continue
+        package_elem = xml.SubElement(packages_elem, 'package', attrib)
+        classes_elem = xml.SubElement(package_elem, 'classes')
+        package_totals = [0, 0, 0, 0]
+        for filename in filenames:
+            class_attrib, methods, lines = classes[filename]
+            class_elem = xml.SubElement(classes_elem, 'class', class_attrib)
+            methods_elem = xml.SubElement(class_elem, 'methods')
+            for method_attrib, method_lines in methods.values():
+                method_elem = xml.SubElement(methods_elem, 'method', method_attrib)
+                setRates(method_elem, writeLines(method_elem, method_lines))
+            counts = setRates(class_elem, writeLines(class_elem, lines))
+            package_totals = [a + b for a, b in zip(package_totals, counts)]
+        setRatesFromCounts(package_elem, package_totals)
+        totals = [a + b for a, b in zip(totals, package_totals)]
+    setRatesFromCounts(root, totals)
+    for name, count in zip(('lines-covered', 'lines-valid', 'branches-covered', 'branches-valid'), totals):
+        if name in root.attrib:
+            root.set(name, str(count))
+    xml.ElementTree(root).write(outfile, encoding="utf-8",xml_declaration=True)
+    if resolver is not None:
+        resolver.save()
+    print(summary.stats())
+    print("Merged %d reports: %d files" % (len(reports), len(classes)))
+
+def writeLines(elem, lines):
+    lines_elem = xml.SubElement(elem, 'lines')
+    for number in sorted(lines, key=int):
+        xml.SubElement(lines_elem, 'line', lines[number])
+    return [lines[number] for number in lines]
+
+#----------- Write the coverage of files as lcov tracefile -----------
+# Branches are only known by their number per line, so each line gets that
+# many anonymous branches, the covered ones first
+def writeLcov(out, classes):
+    for filename, (attrib, methods, lines) in classes.items():
+        out.write("TN:\nSF:%s\n" % filename)
+        functions = []
+        for (name, signature), (method_attrib, method_lines) in methods.items():
+            if method_lines:
+                hits = max(int(line.get('hits', 0)) for line in method_lines.values())
+                functions.append((min(int(number) for number in method_lines), name, hits))
+        for first_line, name, hits in functions:
+            out.write("FN:%d,%s\n" % (first_line, name))
+        for first_line, name, hits in functions:
+            out.write("FNDA:%d,%s\n" % (hits, name))
+        out.write("FNF:%d\nFNH:%d\n" % (len(functions), sum(1 for function in functions if function[2])))
+        branches = [0, 0]
+        for number in sorted(lines, key=int):
+            hits = int(lines[number].get('hits', 0))
+            covered, valid = branchCoverage(lines[number])
+            for branch in range(valid):
+                taken = "-" if not hits else "1" if branch < covered else "0"
+                out.write("BRDA:%s,0,%d,%s\n" % (number, branch, taken))
+            branches[0] += valid
+            branches[1] += covered if hits else 0
+        out.write("BRF:%d\nBRH:%d\n" % tuple(branches))
+        for number in sorted(lines, key=int):
+            out.write("DA:%s,%s\n" % (number, lines[number].get('hits', 0)))
+        out.write("LF:%d\nLH:%d\nend_of_record\n"
+                  % (len(lines), sum(1 for line in lines.values() if int(line.get('hits', 0)))))
+
+#----------- Write the coverage of files as compact JSON -----------
+# {"coverage": {"<filename>": {"<line>": <hits> or "<covered>/<valid> branches"}}},
+# the custom coverage format codecov.io accepts. Written file by file.
+def writeJson(out, classes):
+    out.write('{"coverage":{')
+    for index, (filename, (attrib, methods, lines)) in enumerate(classes.items()):
+        coverage = []
+        for number in sorted(lines, key=int):
+            covered, valid = branchCoverage(lines[number])
+            if valid:
+                coverage.append('"%s":"%d/%d"' % (number, covered, valid))
+            else:
+                coverage.append('"%s":%d' % (number, int(lines[number].get('hits', 0))))
+        out.write('%s%s:{%s}' % ("," if index else "", json.dumps(filename), ",".join(coverage)))
+    out.write('}}\n')
+
 def main(argv):
-    inputfile = ''
+    inputfiles = []
     outputfile = ''
     sourcedir = ''
+    streaming = False
+    jobs = None
+    rulesfile = None
+    cachefile = None
+    gitstamps = False
+    outputformat = "cobertura"
+    usage = ('fixcoveragepaths.py -i <inputfile> [-i <inputfile>...] -s <sourcedirectory> -o <outputfile> '
+             '[-t] [-j <jobs>] [-r <rulesfile> | -c <cachefile> [-g]] [-f cobertura|lcov|json]')
     try:
-        opts, args = getopt.getopt(argv,"hi:o:s:",["ifile=","ofile=","sdir="])
+        opts, args = getopt.getopt(argv,"hi:o:s:tj:r:c:gf:",["ifile=","ofile=","sdir=","stream","jobs=","rules=",
+                                                              "cache=","git-stamps","format="])
     except getopt.GetoptError:
-        print('fixcoveragepaths.py -i <inputfile> -s <sourcedirectory> -o <outputfile>')
+        print(usage)
         sys.exit(2)
     for opt, arg in opts:
         if opt == '-h':
-            print('fixcoveragepaths.py -i <inputfile> -s <sourcedirectory> -o <outputfile>')
+            print(usage)
+            print('  -t, --stream  rewrite the report while parsing it, in bounded memory')
+            print('  -j, --jobs    number of processes fixing the reports to merge when more')
+            print('                than one input file is given (default: one per core)')
+            print('  -r, --rules   remap the paths by the "<from> => <to>" rules in rulesfile')
+            print('                instead of looking them up in the source directory, which')
+            print('                then is optional')
+            print('  -c, --cache   keep the directory listings used to resolve paths in cachefile')
+            print('                and reuse them in later runs while the directories are unchanged')
+            print('  -g, --git-stamps')
+            print('                detect changes of directories tracked by git by their tree hash')
+            print('                at HEAD instead of their mtime')
+            print('  -f, --format  write the fixed report as Cobertura XML (default), lcov tracefile')
+            print('                or compact JSON as accepted by codecov.io')
             sys.exit()
         elif opt in ("-i", "--ifile"):
-            inputfile = arg
+            inputfiles.append(arg)
         elif opt in ("-o", "--ofile"):
             outputfile = arg
         elif opt in ("-s", "--sdir"):
             sourcedir = arg
+        elif opt in ("-t", "--stream"):
+            streaming = True
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-r", "--rules"):
+            rulesfile = arg
+        elif opt in ("-c", "--cache"):
+            cachefile = arg
+        elif opt in ("-g", "--git-stamps"):
+            gitstamps = True
+        elif opt in ("-f", "--format"):
+            if arg not in ("cobertura", "lcov", "json"):
+                print(usage)
+                sys.exit(2)
+            outputformat = arg
     #print('Input file is ', inputfile)
     #print ('Output file is ', outputfile)
     #print ('Sources directory is ', sourcedir)
-    modifyXML(inputfile, sourcedir, outputfile)
+    resolver = None
+    if rulesfile:
+        resolver = PathRemapper(readRules(rulesfile))
+    elif cachefile:
+        tree_hashes = None
+        if gitstamps:
+            tree_hashes = gitTreeHashes(sourcedir or os.curdir)
+            if tree_hashes is None:
+                print("No git repository found, using mtimes to validate the cache")
+        resolver = CasedPathResolver(cachefile, tree_hashes)
+    if len(inputfiles) > 1 or outputformat != "cobertura":
+        mergeReports(inputfiles, sourcedir, outputfile, jobs, resolver, outputformat)
+    elif streaming:
+        modifyXMLStreaming(inputfiles[0], sourcedir, outputfile, resolver)
+    else:
+        modifyXML(inputfiles[0], sourcedir, outputfile, resolver)
     
 #----------------------------------------------------------------------
 if __name__ == "__main__":
@@ -0,0 +1,322 @@
+# Tests for fixcoveragefilepaths.py. Reports are synthetic Cobertura reports
+# written to a temporary directory; paths are remapped by rules where the
+# filesystem does not matter, so the tests run on any platform.
+# Run with: python -m unittest testfixcoveragefilepaths
+
+import xml.etree.ElementTree as xml
+import contextlib, ntpath, os, shutil, sys, tempfile, unittest
+import fixcoveragefilepaths as fix
+
+report1 = '''<?xml version="1.0" encoding="utf-8"?>
+<coverage line-rate="0.5" branch-rate="0.5" lines-covered="2" lines-valid="3" version="1.9" timestamp="1">
+  <sources><source>C:\\src</source></sources>
+  <packages>
+    <package name="p1" line-rate="0.5" branch-rate="0.5">
+      <classes>
+        <class name="x.cpp" filename="A\\x.cpp" line-rate="0.5" branch-rate="0.5">
+          <methods>
+            <method name="f" signature="()" line-rate="1" branch-rate="0">
+              <lines><line number="1" hits="1" /></lines>
+            </method>
+          </methods>
+          <lines>
+            <line number="1" hits="1" />
+            <line number="2" hits="0" />
+            <line number="3" hits="2" branch="true" condition-coverage="50% (1/2)" />
+          </lines>
+        </class>
+      </classes>
+    </package>
+  </packages>
+</coverage>
+'''
+
+report2 = '''<?xml version="1.0" encoding="utf-8"?>
+<coverage line-rate="0.25" branch-rate="1" version="1.9" timestamp="2">
+  <sources><source>C:\\src</source></sources>
+  <packages>
+    <package name="p1" line-rate="0.25" branch-rate="1">
+      <classes>
+        <class name="x.cpp" filename="A\\x.cpp" line-rate="0.25" branch-rate="1">
+          <methods>
+            <method name="f" signature="()" line-rate="0" branch-rate="0">
+              <lines><line number="1" hits="0" /><line number="2" hits="3" /></lines>
+            </method>
+          </methods>
+          <lines>
+            <line number="2" hits="3" />
+            <line number="3" hits="0" branch="true" condition-coverage="100% (2/2)" />
+            <line number="4" hits="0" />
+          </lines>
+        </class>
+      </classes>
+    </package>
+    <package name="p2" line-rate="0" branch-rate="0">
+      <classes>
+        <class name="y.cpp" filename="B\\y.cpp" line-rate="0" branch-rate="0">
+          <methods />
+          <lines><line number="1" hits="0" /></lines>
+        </class>
+      </classes>
+    </package>
+  </packages>
+</coverage>
+'''
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+class CoverageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def write(self, name, text):
+        with open(self.path(name), "w") as f:
+            f.write(text)
+        return self.path(name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+class TestMergeReports(CoverageTestCase):
+    def merge(self, jobs):
+        infiles = [self.write("r1.xml", report1), self.write("r2.xml", report2)]
+        with quiet():
+            fix.mergeReports(infiles, "", self.path("merged.xml"), jobs,
+                             fix.PathRemapper([("C:\\src\\", "")]))
+        return xml.ElementTree(file=self.path("merged.xml")).getroot()
+
+    def lines(self, elem):
+        return [(line.get("number"), line.get("hits"), line.get("condition-coverage"))
+                for line in elem.findall("lines/line")]
+
+    def rates(self, elem):
+        return elem.get("line-rate"), elem.get("branch-rate")
+
+    def test_merge(self):
+        for jobs in (1, 2):
+            root = self.merge(jobs)
+            packages = root.findall("packages/package")
+            self.assertEqual([package.get("name") for package in packages], ["p1", "p2"])
+            x, = packages[0].findall("classes/class")
+            y, = packages[1].findall("classes/class")
+            self.assertEqual((x.get("filename"), y.get("filename")), ("A/x.cpp", "B/y.cpp"))
+            # Hits are added up, the most covered branches win
+            self.assertEqual(self.lines(x), [("1", "1", None), ("2", "3", None),
+                                             ("3", "2", "100% (2/2)"), ("4", "0", None)])
+            self.assertEqual(self.lines(x.find("methods/method")), [("1", "1", None),
+                                                                    ("2", "3", None)])
+            self.assertEqual(self.lines(y), [("1", "0", None)])
+            # Rates are recomputed at every level
+            self.assertEqual(self.rates(x.find("methods/method")), ("1", "0"))
+            self.assertEqual(self.rates(x), ("0.75", "1"))
+            self.assertEqual(self.rates(y), ("0", "0"))
+            self.assertEqual(self.rates(packages[0]), ("0.75", "1"))
+            self.assertEqual(self.rates(packages[1]), ("0", "0"))
+            self.assertEqual(self.rates(root), ("0.6", "1"))
+            self.assertEqual((root.get("lines-covered"), root.get("lines-valid")), ("3", "5"))
+            self.assertEqual(root.find("sources/source").text, "C:\\src")
+
+class TestPathRemapper(CoverageTestCase):
+    rules = [("C:\\agent\\", "agent/"),
+             ("c:/agent/work/", "work/"),
+             ("C:\\agent\\work\\s\\", ""),
+             ("re:C:/agent/work/s/(\\w+)/gen/", "generated/\\1/"),
+             ("re:[A-Z]:/build/([^/]+)/", "build/\\1/")]
+
+    def test_resolve(self):
+        cases = [
+            # The longest prefix wins, matched case-insensitively with / and \ alike
+            ("C:\\agent\\work\\s\\src\\a.cpp", "src/a.cpp"),
+            ("c:/AGENT/Work/S/src/a.cpp", "src/a.cpp"),
+            ("C:\\agent\\work\\other\\a.cpp", "work/other/a.cpp"),
+            ("C:\\agent\\Work.cpp", "agent/Work.cpp"),
+            # Regular expressions take priority over prefixes
+            ("C:\\agent\\work\\s\\lib\\gen\\b.cpp", "generated/lib/b.cpp"),
+            ("D:\\build\\x64\\c.cpp", "build/x64/c.cpp"),
+            # Unmatched paths are kept as is
+            ("D:\\other\\d.cpp", "D:\\other\\d.cpp"),
+            ("C:\\agen", "C:\\agen"),
+        ]
+        remapper = fix.PathRemapper(self.rules)
+        for path, expected in cases:
+            self.assertEqual(remapper.resolve(path), expected, path)
+        self.assertEqual((remapper.matched, remapper.unmatched), (6, 2))
+
+    def test_read_rules(self):
+        rules = self.write("rules.txt", "# comment\n\nC:\\a\\ => b/\nC:\\c\\ =>\n")
+        self.assertEqual(fix.readRules(rules), [("C:\\a\\", "b/"), ("C:\\c\\", "")])
+        self.write("bad.txt", "C:\\a\\ b/\n")
+        self.assertRaises(ValueError, fix.readRules, self.path("bad.txt"))
+
+    def test_rules_and_source(self):
+        # With -r, -s only replaces <source>
+        rules = self.write("rules.txt", "C:\\src\\ =>\nre:C:/src/B/ => lib/\n")
+        for stream in ([], ["-t"]):
+            with quiet():
+                fix.main(["-i", self.write("r2.xml", report2), "-r", rules, "-s", "/repo",
+                          "-o", self.path("out.xml")] + stream)
+            root = xml.ElementTree(file=self.path("out.xml")).getroot()
+            self.assertEqual(root.find("sources/source").text, "/repo")
+            self.assertEqual([(elem.get("name"), elem.get("filename")) for elem in root.iter("class")],
+                             [("x.cpp", "A/x.cpp"), ("y.cpp", "lib/y.cpp")])
+
+class FakeWindowsOs(object):
+    # Stands in for the os module of fixcoveragefilepaths with Windows paths
+    # and a case-insensitive filesystem of directory path -> entries
+    path = ntpath
+    curdir = "."
+    sep = "\\"
+
+    def __init__(self, dirs):
+        self.dirs = dict((ntpath.normcase(directory), entries) for directory, entries in dirs.items())
+
+    def listdir(self, directory):
+        return self.dirs[ntpath.normcase(ntpath.normpath(directory))]
+
+class TestCasedPaths(unittest.TestCase):
+    def setUp(self):
+        fs = FakeWindowsOs({"Z:\\": ["Repo"], "Z:\\Repo": ["Src"], "Z:\\Repo\\Src": ["A.cpp"]})
+        self.addCleanup(setattr, fix, "os", fix.os)
+        fix.os = fs
+
+    def fix(self, source, sourcepath, filename):
+        elem = xml.Element("class", filename=filename)
+        fix.fixClassPath(elem, source, fix.sourcePrefix(source, sourcepath),
+                         fix.CasedPathResolver())
+        return elem.get("filename")
+
+    def test_source_separators(self):
+        self.assertEqual(self.fix("z:\\repo", "Z:\\Repo", "src\\a.cpp"), "Src\\A.cpp")
+        # A <source> ending in a separator doubles it
+        self.assertEqual(self.fix("Z:\\", "Z:\\", "repo\\src\\a.cpp"), "Repo\\Src\\A.cpp")
+        self.assertEqual(self.fix("z:\\repo\\", "Z:\\Repo\\", "src\\a.cpp"), "Src\\A.cpp")
+
+class TestResolverCache(CoverageTestCase):
+    # Paths are resolved relative to a tree of their own, so the stamps of
+    # the directories above it, like the temporary directory, do not matter
+    def setUp(self):
+        CoverageTestCase.setUp(self)
+        self.cwd = os.getcwd()
+        os.makedirs(self.path(os.path.join("tree", "Src", "Lib")))
+        self.write(os.path.join("tree", "Src", "Lib", "File.cpp"), "")
+        self.cachefile = self.path("cache.json")
+        os.chdir(self.path("tree"))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        CoverageTestCase.tearDown(self)
+
+    def resolve(self, tree_hashes=None):
+        resolver = fix.CasedPathResolver(self.cachefile, tree_hashes)
+        resolved = resolver.resolve("src\\lib\\file.cpp")
+        resolver.save()
+        return resolved, resolver
+
+    def test_mtime_stamps(self):
+        lib = os.path.join("Src", "Lib")
+        os.utime(lib, (1000000000, 1000000000))
+        resolved, resolver = self.resolve()
+        self.assertEqual(resolved, os.path.join(lib, "File.cpp"))
+        self.assertEqual((resolver.scanned, resolver.reused), (3, 0))
+        # Unchanged directories are not scanned again
+        resolved, resolver = self.resolve()
+        self.assertEqual((resolver.scanned, resolver.reused), (0, 3))
+        # A stale entry is discarded
+        os.rename(os.path.join(lib, "File.cpp"), os.path.join(lib, "FILE.cpp"))
+        os.utime(lib, (1000000001, 1000000001))
+        resolved, resolver = self.resolve()
+        self.assertEqual(resolved, os.path.join(lib, "FILE.cpp"))
+        self.assertEqual((resolver.scanned, resolver.reused), (1, 2))
+
+    def test_git_stamps(self):
+        stamps = lambda sha: dict((os.path.normcase(os.path.abspath(directory)), sha + directory)
+                                  for directory in (os.curdir, "Src", os.path.join("Src", "Lib")))
+        self.resolve(stamps("a"))
+        # Tree hashes take precedence over mtimes
+        os.utime(os.path.join("Src", "Lib"), (1000000002, 1000000002))
+        resolved, resolver = self.resolve(stamps("a"))
+        self.assertEqual((resolver.scanned, resolver.reused), (0, 3))
+        # A stale entry is discarded
+        resolved, resolver = self.resolve(stamps("b"))
+        self.assertEqual((resolver.scanned, resolver.reused), (3, 0))
+        self.assertEqual(resolved, os.path.join("Src", "Lib", "File.cpp"))
+
+    def test_new_files(self):
+        stamps = dict((os.path.normcase(os.path.abspath(directory)), "a" + directory)
+                      for directory in (os.curdir, "Src", os.path.join("Src", "Lib")))
+        self.resolve(stamps)
+        # Untracked files do not change the tree hashes
+        self.write(os.path.join("tree", "Src", "Lib", "New.cpp"), "")
+        resolver = fix.CasedPathResolver(self.cachefile, stamps)
+        self.assertEqual(resolver.resolve("src\\lib\\new.cpp"), os.path.join("Src", "Lib", "New.cpp"))
+        self.assertEqual((resolver.scanned, resolver.reused), (1, 3))
+        # Names missing after the rescan are given up on
+        self.assertEqual(resolver.resolve("src\\lib\\gone.cpp"), "src\\lib\\gone.cpp")
+        self.assertEqual((resolver.scanned, resolver.reused), (1, 3))
+        resolver.save()
+        resolved, resolver = self.resolve(stamps)
+        self.assertEqual((resolver.scanned, resolver.reused), (0, 3))
+
+    def test_corrupt_cache(self):
+        for text in ('{"version": 1, "dirs": {', '[1, 2]', '{"version": 1, "dirs": []}'):
+            self.write("cache.json", text)
+            resolved, resolver = self.resolve()
+            self.assertEqual(resolved, os.path.join("Src", "Lib", "File.cpp"))
+            self.assertEqual((resolver.scanned, resolver.reused), (3, 0))
+            # The cache is rewritten
+            resolved, resolver = self.resolve()
+            self.assertEqual((resolver.scanned, resolver.reused), (0, 3))
+
+class TestOutputFormats(CoverageTestCase):
+    def convert(self, reports, outputformat):
+        infiles = [self.write("r%d.xml" % index, report) for index, report in enumerate(reports)]
+        with quiet():
+            fix.mergeReports(infiles, "", self.path("out"), 1,
+                             fix.PathRemapper([("C:\\src\\", "")]), outputformat)
+        return self.read("out")
+
+    def test_lcov(self):
+        self.assertEqual(self.convert([report1, report2], "lcov"),
+                         "TN:\nSF:A/x.cpp\n"
+                         "FN:1,f\nFNDA:3,f\nFNF:1\nFNH:1\n"
+                         "BRDA:3,0,0,1\nBRDA:3,0,1,1\nBRF:2\nBRH:2\n"
+                         "DA:1,1\nDA:2,3\nDA:3,2\nDA:4,0\nLF:4\nLH:3\n"
+                         "end_of_record\n"
+                         "TN:\nSF:B/y.cpp\n"
+                         "FNF:0\nFNH:0\nBRF:0\nBRH:0\n"
+                         "DA:1,0\nLF:1\nLH:0\n"
+                         "end_of_record\n")
+        self.assertEqual(self.convert([report1], "lcov"),
+                         "TN:\nSF:A/x.cpp\n"
+                         "FN:1,f\nFNDA:1,f\nFNF:1\nFNH:1\n"
+                         "BRDA:3,0,0,1\nBRDA:3,0,1,0\nBRF:2\nBRH:1\n"
+                         "DA:1,1\nDA:2,0\nDA:3,2\nLF:3\nLH:2\n"
+                         "end_of_record\n")
+        # Branches of lines never executed are not taken
+        lcov = self.convert([report2], "lcov")
+        self.assertIn("BRDA:3,0,0,-\nBRDA:3,0,1,-\nBRF:2\nBRH:0\n", lcov)
+
+    def test_json(self):
+        self.assertEqual(self.convert([report1, report2], "json"),
+                         '{"coverage":{"A/x.cpp":{"1":1,"2":3,"3":"2/2","4":0},'
+                         '"B/y.cpp":{"1":0}}}\n')
+        self.assertEqual(self.convert([report1], "json"),
+                         '{"coverage":{"A/x.cpp":{"1":1,"2":0,"3":"1/2"}}}\n')
+
+if __name__ == "__main__":
+    unittest.main()